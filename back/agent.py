@@ -1,62 +1,35 @@
 import os
 import json
+import time
 from cmath import phase
 from dotenv import load_dotenv
-from typing import Callable, Optional
+from typing import Callable, Iterator, Optional
 from typing_extensions import TypedDict, Literal, Annotated
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langchain_core.messages import HumanMessage, AIMessage
 
-from models.gemini import call_gemini
-from models.medgemma import call_medgemma
+from models.gemini import call_gemini, stream_gemini
+from models.router import call_model, schema_instructions
+from persona import VirtualPatientPersona, generate_persona, save_persona
+from session_events import record_event
+from prompt_builder import build_phase_prompt, checklist_cache, ensure_session_id
+from token_accounting import accounting_context, compact_messages, estimate_tokens, input_budget, render_messages
 
 load_dotenv()
 
+# Backend generating the report and the virtual patient persona
+REPORT_BACKEND = os.getenv("REPORT_MODEL", "medgemma")
+# Output tokens reserved for the report and the virtual patient persona
+REPORT_MAX_TOKENS = 4096
+
 class SessionState(TypedDict):
     checklist: dict
     phase: Literal["summary", "diff", "lead", "alts", "errors", "plan", "final_feedback", "outputs"]
     history: Annotated[list, add_messages]
     report: str
     virtual_patient: str
-
-PHASE_PROMPTS = {
-    "summary": """
-    <|BEGINING_TUTORING_SESSION|>
-    Given the checklist, open the tutoring session by asking the student to summarize the findings. Do not provide summary by yourself. Do not provide the diagnosis by yourself. Do not provide hints.
-    Checklist: {checklist}
-    """,
-
-    "diff": """
-    You are guiding diagnosis and differential diagnosis. Ask student to provide you with main diagnosis and with 3-5 possible alternative diagnosis and the reasoning behind them. Do not give the examples, do not provide diagnosis by yourself, do not provide student's response.
-    Student reasoning so far: {last}
-    """,
-
-    "lead": """
-    Help student with diagnosis selection. Ask student for the lead and what supports or contradicts it. Do not provide answers.
-    Student reasoning so far: {last}
-    """,
-
-    "alts": """
-    Help student with alternative diagnosis. Ask what that diagnosis may be, and for the reasoning to rule in/out each option.  Do not provide answers.
-    Student reasoning so far: {last}
-    """,
-
-    "errors": """
-    Help student to reflect on biases/errors. Ask him about possible biases, missing evidence. Do not provide answers.
-    Student reasoning so far: {last}
-    """,
-
-    "plan": """
-    Help student with management plan. Ask student about potential tests, treatments, follow-ups and their justification.  Do not provide answers.
-    Student reasoning so far: {last}
-    """,
-
-    "final_feedback": """
-    Reflect briefly on the session and student's answers (no more than 2-3 sentences). If the student did not answer well or did not provide the answer, please highlight the weaknesses. Then thank them and tell them a report and virtual patient will be created next. Give a brief overall feedback as a tutor .
-    Student reasoning so far: {last}
-    """
-}
+    session_id: str
 
 def make_phase_node(phase_name: str) -> Callable[[SessionState], SessionState]:
     """
@@ -64,11 +37,7 @@ def make_phase_node(phase_name: str) -> Callable[[SessionState], SessionState]:
     Handles student-tutor interaction and updates the session state with messages.
     """
     def node(state: SessionState) -> SessionState:
-        last = state["history"][-1].content if state["history"] else ""
-        prompt = PHASE_PROMPTS[phase_name].format(
-            checklist=json.dumps(state["checklist"], indent=2),
-            last=last
-        )
+        prompt = build_phase_prompt(phase_name, state)
         # Call Gemini
         tutor_msg = call_gemini(prompt=prompt, max_tokens=2048, temperature=0)
         # Call MedGemma
@@ -79,7 +48,6 @@ def make_phase_node(phase_name: str) -> Callable[[SessionState], SessionState]:
         if phase_name == "final_feedback":
             return {
                 "history": state["history"] + [
-                    HumanMessage(content=prompt),
                     AIMessage(content=tutor_msg)
                 ],
                 "phase": phase_name
@@ -89,7 +57,6 @@ def make_phase_node(phase_name: str) -> Callable[[SessionState], SessionState]:
 
         return {
             "history": state["history"] + [
-                HumanMessage(content=prompt),
                 AIMessage(content=tutor_msg),
                 HumanMessage(content=student_msg)
             ],
@@ -97,6 +64,16 @@ def make_phase_node(phase_name: str) -> Callable[[SessionState], SessionState]:
         }
     return node
 
+def _session_transcript(state: SessionState, budget: int) -> str:
+    """
+    Checklist followed by the tutor/student exchange. Phase instructions are not
+    stored in the history, so the checklist is prepended explicitly.
+    The exchange is compacted to fit in budget tokens.
+    """
+    checklist = f"Checklist: {checklist_cache.get(state.get('session_id'), state.get('checklist', {}))}\n"
+    messages = compact_messages([m.content for m in state["history"]], budget - estimate_tokens(checklist))
+    return checklist + render_messages(messages)
+
 builder = StateGraph(SessionState)
 
 for phase in ["summary", "diff", "lead", "alts", "errors", "plan", "final_feedback", "outputs"]:
@@ -108,11 +85,10 @@ def generate_report(state: SessionState) -> dict:
     """
     prompt = """Generate a final session report in plain text. Include the initial checklist and a summary of the student’s reasoning. Clearly highlight the student’s strengths and weaknesses in clinical thinking. Avoid repetition and keep the tone professional and constructive.
     """
-    msg = json.dumps([m.content for m in state["history"]], indent=2) + prompt
-    # Call Gemini
-    # response = call_gemini(prompt=msg)
-    # Call MedGemma
-    response = call_medgemma(prompt=msg)
+    msg = _session_transcript(state, input_budget(REPORT_BACKEND, REPORT_MAX_TOKENS) - estimate_tokens(prompt)) + prompt
+    # MedGemma by default, failing over to Gemini when it is unhealthy
+    with accounting_context(state.get("session_id"), "report"):
+        response = call_model(REPORT_BACKEND, prompt=msg, max_tokens=REPORT_MAX_TOKENS)
     return {
         "report": response
     }
@@ -122,26 +98,50 @@ def generate_virtual_patient_persona(state: SessionState) -> dict:
     Generates a virtual patient case based on the student's weaknesses using the conversation history.
     """
     prompt = "Generate a virtual patient persona in JSON format to help the student practice and improve their medical reasoning. Base the persona on the student's initial checklist, errors identified in the report, and the conversation history. Include only patient-relevant information that allows the student to ask diagnostic and clinical questions. Do not include any diagnoses, learning plans, or tutor comments"
-    msg = json.dumps([m.content for m in state["history"]], indent=2) + prompt
-    # Call Gemini
-    # response = call_gemini(prompt=msg)
-    # Call MedGemma
-    response = call_medgemma(prompt=msg)
+    # MedGemma gets the persona schema appended to the prompt, so it is left out of the transcript budget
+    budget = input_budget(REPORT_BACKEND, REPORT_MAX_TOKENS) - estimate_tokens(prompt) - estimate_tokens(schema_instructions(VirtualPatientPersona))
+    msg = _session_transcript(state, budget) + prompt
+    # MedGemma by default, failing over to Gemini when it is unhealthy; output is validated against VirtualPatientPersona
+    with accounting_context(state.get("session_id"), "virtual_patient"):
+        persona = generate_persona(REPORT_BACKEND, prompt=msg, max_tokens=REPORT_MAX_TOKENS)
     return {
-        "virtual_patient": response
+        "virtual_patient": persona.model_dump_json()
     }
 
-def generate_and_store_report_and_patient(state):
-    report = generate_report(state)["report"]
-    virtual_patient = generate_virtual_patient_persona(state)["virtual_patient"]
+def _record_output(state, output: str, text: str, started: float) -> None:
+    record_event(
+        "output",
+        session_id=state.get("session_id"),
+        phase="outputs",
+        mode=output,
+        response_chars=len(text),
+        latency_s=time.perf_counter() - started,
+        response=text,
+    )
 
+def generate_and_store_report_and_patient(state, on_ready: Optional[Callable[[str], None]] = None):
+    """
+    Generates and stores the report, then the virtual patient persona.
+    on_ready, if given, is called with "report" and "virtual_patient" as each file is written.
+    """
+    started = time.perf_counter()
+    report = generate_report(state)["report"]
     os.makedirs("data/reports", exist_ok=True)
     with open("data/reports/report_reel.txt", "w") as f:
         f.write(report)
+    _record_output(state, "report", report, started)
+    if on_ready:
+        on_ready("report")
 
-    os.makedirs("data/checklists", exist_ok=True)
-    with open("data/checklists/checklist_virtuel.txt", "w") as f:
-        f.write(virtual_patient)
+    started = time.perf_counter()
+    virtual_patient = generate_virtual_patient_persona(state)["virtual_patient"]
+    save_persona(VirtualPatientPersona.model_validate_json(virtual_patient))
+    _record_output(state, "virtual_patient", virtual_patient, started)
+    if on_ready:
+        on_ready("virtual_patient")
+
+    if state.get("session_id"):
+        checklist_cache.discard(state["session_id"])
 
 builder.add_node("report", generate_report)
 builder.add_node("virtual_patient", generate_virtual_patient_persona)
@@ -176,34 +176,42 @@ def _ensure_message_objects(history):
             new_history.append(msg)
     return new_history
 
-def step_agent(state: SessionState, user_message: Optional[str] = None, system_prompt: Optional[str] = None) -> dict:
+PHASE_ORDER = ["summary", "diff", "final_feedback", "outputs"]
+
+def _begin_step(state: SessionState) -> str:
     """
-    Advances the agent by one phase using the provided user message.
-    Returns the updated state and the AI's next message.
+    Normalizes the incoming state and returns the instruction for its current phase.
     """
     # Ensure history is a list of message objects
     state["history"] = _ensure_message_objects(state.get("history", []))
-    # Allowed phases
-    phase_order = ["summary", "diff", "final_feedback", "outputs"]
-    # Determine current phase
+    ensure_session_id(state)
+    # Prepare prompt for the current phase; it is sent to the model but not stored in history
+    return build_phase_prompt(state["phase"], state)
+
+def _complete_step(state: SessionState, prompt: str, tutor_msg: str, user_message: Optional[str], started: float) -> None:
+    """
+    Records the tutor reply and the student message, then advances the phase.
+    """
     phase = state["phase"]
-    # Prepare prompt for the current phase
-    last = state["history"][-1].content if state["history"] else ""
-    prompt = PHASE_PROMPTS[phase].format(
-        checklist=json.dumps(state["checklist"], indent=2),
-        last=last
+    record_event(
+        "turn",
+        session_id=state["session_id"],
+        phase=phase,
+        mode="tutor",
+        prompt_chars=len(prompt),
+        response_chars=len(tutor_msg),
+        latency_s=time.perf_counter() - started,
+        message=user_message,
+        response=tutor_msg,
     )
-    # Call Gemini
-    tutor_msg = call_gemini(prompt=prompt, max_tokens=2048, temperature=0, system_prompt=system_prompt)
     # Update history with tutor message
-    state["history"].append(HumanMessage(content=prompt))
     state["history"].append(AIMessage(content=tutor_msg))
     # If not final_feedback, add user message if provided
     if phase != "final_feedback" and user_message is not None:
         state["history"].append(HumanMessage(content=user_message))
     # Advance phase
-    next_phase_idx = phase_order.index(phase) + 1 if phase in phase_order else len(phase_order) - 1
-    next_phase = phase_order[next_phase_idx] if next_phase_idx < len(phase_order) else phase_order[-1]
+    next_phase_idx = PHASE_ORDER.index(phase) + 1 if phase in PHASE_ORDER else len(PHASE_ORDER) - 1
+    next_phase = PHASE_ORDER[next_phase_idx] if next_phase_idx < len(PHASE_ORDER) else PHASE_ORDER[-1]
     state["phase"] = next_phase  # Always a valid literal
     # Ensure all required fields are present
     if "checklist" not in state:
@@ -213,8 +221,35 @@ def step_agent(state: SessionState, user_message: Optional[str] = None, system_p
     if "virtual_patient" not in state:
         state["virtual_patient"] = ""
 
+def step_agent(state: SessionState, user_message: Optional[str] = None, system_prompt: Optional[str] = None) -> dict:
+    """
+    Advances the agent by one phase using the provided user message.
+    Returns the updated state and the AI's next message.
+    """
+    started = time.perf_counter()
+    prompt = _begin_step(state)
+    # Call Gemini
+    with accounting_context(state["session_id"], state["phase"]):
+        tutor_msg = call_gemini(prompt=prompt, max_tokens=2048, temperature=0, system_prompt=system_prompt)
+    _complete_step(state, prompt, tutor_msg, user_message, started)
+
     return {"state": state, "ai_message": tutor_msg}
 
+def stream_step_agent(state: SessionState, user_message: Optional[str] = None, system_prompt: Optional[str] = None) -> Iterator[str]:
+    """
+    Same as step_agent, but yields the tutor reply chunk by chunk.
+    The state is updated in place once the stream is exhausted.
+    """
+    started = time.perf_counter()
+    prompt = _begin_step(state)
+    with accounting_context(state["session_id"], state["phase"]):
+        stream = stream_gemini(prompt=prompt, max_tokens=2048, temperature=0, system_prompt=system_prompt)
+    chunks = []
+    for chunk in stream:
+        chunks.append(chunk)
+        yield chunk
+    _complete_step(state, prompt, "".join(chunks).strip(), user_message, started)
+
 if __name__ == "__main__":
     init_state: SessionState = {
         "checklist": {
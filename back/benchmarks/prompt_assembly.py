@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of tutor prompt assembly: build cost and bytes per turn.
+
+Compares the previous approach (str.format with an indented checklist dump on
+every turn, phase instruction stored in history) with the compiled templates
+and per-session checklist cache.
+
+Run from back/:
+    python -m benchmarks.prompt_assembly
+"""
+import json
+import timeit
+
+from prompt_builder import build_phase_prompt, checklist_cache
+from prompts.phases import PHASE_PROMPTS
+
+PHASES = ["summary", "diff", "final_feedback"]
+ITERATIONS = 20000
+
+CHECKLIST = {
+    "patient": {"age": 67, "sex": "M", "smoker": True, "pack_years": 40},
+    "symptoms": ["dyspnée d'effort", "toux chronique", "expectorations matinales", "orthopnée"],
+    "history": ["HTA", "diabète de type 2", "exposition professionnelle à l'amiante"],
+    "vitals": {"temp": 37.2, "hr": 98, "bp": "145/90", "rr": 24, "spo2": 91},
+    "exam": {
+        "pulmonary": ["sibilants diffus", "crépitants des bases", "distension thoracique"],
+        "cardiac": ["B3", "turgescence jugulaire"],
+        "other": ["œdèmes des membres inférieurs"],
+    },
+    "tests": {"nt_probnp": 1450, "spirometry": "VEMS/CVF 0.62", "xray": "syndrome interstitiel"},
+}
+
+STUDENT_ANSWERS = [
+    "The patient is a 67 year old smoker with chronic exertional dyspnea, orthopnea and hypoxemia.",
+    "My main diagnosis is COPD exacerbation with heart failure; alternatives are pneumonia, PE, asbestosis.",
+    "I think I covered everything.",
+]
+TUTOR_REPLY = "Thank you. Can you explain what supports this hypothesis and what argues against it? " * 3
+
+
+def _legacy_prompt(phase, state):
+    last = state["history"][-1]["content"] if state["history"] else ""
+    return PHASE_PROMPTS[phase].format(checklist=json.dumps(state["checklist"], indent=2), last=last)
+
+
+def _run_session(build, store_instruction):
+    """Simulates one tutoring session and returns (prompt bytes, state bytes) per turn."""
+    state = {"checklist": CHECKLIST, "history": [], "session_id": "bench"}
+    turns = []
+    for phase, answer in zip(PHASES, STUDENT_ANSWERS):
+        prompt = build(phase, state)
+        if store_instruction:
+            state["history"].append({"type": "human", "content": prompt})
+        state["history"].append({"type": "ai", "content": TUTOR_REPLY})
+        state["history"].append({"type": "human", "content": answer})
+        turns.append((len(prompt.encode()), len(json.dumps(state).encode())))
+    return turns
+
+
+def _time_build(build, phase):
+    state = {"checklist": CHECKLIST, "history": [{"content": STUDENT_ANSWERS[0]}], "session_id": "bench"}
+    return timeit.timeit(lambda: build(phase, state), number=ITERATIONS) / ITERATIONS * 1e6
+
+
+def main():
+    checklist_cache.discard("bench")
+    variants = [("legacy", _legacy_prompt, True), ("compiled", build_phase_prompt, False)]
+
+    print(f"{'variant':<10} {'phase':<16} {'build (us)':>12}")
+    for name, build, _ in variants:
+        for phase in PHASES:
+            print(f"{name:<10} {phase:<16} {_time_build(build, phase):>12.2f}")
+
+    print(f"\n{'variant':<10} {'turn':<6} {'prompt bytes':>14} {'state bytes':>13}")
+    for name, build, store_instruction in variants:
+        for i, (prompt_bytes, state_bytes) in enumerate(_run_session(build, store_instruction), 1):
+            print(f"{name:<10} {i:<6} {prompt_bytes:>14} {state_bytes:>13}")
+
+
+if __name__ == "__main__":
+    main()
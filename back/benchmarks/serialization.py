@@ -0,0 +1,93 @@
+"""
+Benchmark of chat payload serialization: encode/decode time and wire bytes.
+
+Compares stdlib json (FastAPI's default), orjson and MessagePack, each raw and
+compressed with gzip and brotli, on the /chat response of a realistic
+4-phase tutoring session. Codecs that are not installed are skipped.
+
+Run from back/:
+    python -m benchmarks.serialization
+"""
+import gzip
+import json
+import timeit
+
+from serialization import BROTLI_QUALITY, GZIP_LEVEL, brotli, msgpack, orjson
+
+ITERATIONS = 2000
+
+CHECKLIST = {
+    "patient": {"age": 67, "sex": "M", "smoker": True, "pack_years": 40},
+    "symptoms": ["dyspnée d'effort", "toux chronique", "expectorations matinales", "orthopnée"],
+    "history": ["HTA", "diabète de type 2", "exposition professionnelle à l'amiante"],
+    "vitals": {"temp": 37.2, "hr": 98, "bp": "145/90", "rr": 24, "spo2": 91},
+    "exam": {
+        "pulmonary": ["sibilants diffus", "crépitants des bases", "distension thoracique"],
+        "cardiac": ["B3", "turgescence jugulaire"],
+    },
+}
+
+TUTOR_REPLY = (
+    "Thank you for your summary. Before we go further, can you tell me which findings you consider "
+    "most significant, and how the orthopnea and the crackles at the bases influence your reasoning? "
+)
+STUDENT_REPLY = (
+    "The patient is a 67 year old smoker with progressive exertional dyspnea, orthopnea and lower limb "
+    "edema. I would consider heart failure first, then COPD, and interstitial lung disease given asbestos. "
+)
+
+
+def session_payload(phases: int = 4) -> dict:
+    history = []
+    for _ in range(phases):
+        history.append({"type": "ai", "content": TUTOR_REPLY * 3})
+        history.append({"type": "human", "content": STUDENT_REPLY * 2})
+    state = {
+        "checklist": CHECKLIST,
+        "phase": "outputs",
+        "history": history,
+        "report": "",
+        "virtual_patient": "",
+        "session_id": "5f0c2d9e8b7a4c3e9d1f2a6b7c8d9e0f",
+    }
+    return {"ai_message": TUTOR_REPLY * 3, "state": state}
+
+
+def _codecs():
+    codecs = [("json", lambda p: json.dumps(p).encode(), json.loads)]
+    if orjson is not None:
+        codecs.append(("orjson", orjson.dumps, orjson.loads))
+    if msgpack is not None:
+        codecs.append(("msgpack", msgpack.packb, msgpack.unpackb))
+    return codecs
+
+
+def _compressors():
+    compressors = [("raw", lambda b: b), ("gzip", lambda b: gzip.compress(b, compresslevel=GZIP_LEVEL))]
+    if brotli is not None:
+        compressors.append(("br", lambda b: brotli.compress(b, quality=BROTLI_QUALITY)))
+    return compressors
+
+
+def main():
+    payload = session_payload()
+    print(f"{'codec':<9} {'encode (us)':>12} {'decode (us)':>12}", end="")
+    compressors = _compressors()
+    for name, _ in compressors:
+        print(f" {name + ' bytes':>11} {name + ' (us)':>10}", end="")
+    print()
+
+    for name, encode, decode in _codecs():
+        body = encode(payload)
+        encode_us = timeit.timeit(lambda: encode(payload), number=ITERATIONS) / ITERATIONS * 1e6
+        decode_us = timeit.timeit(lambda: decode(body), number=ITERATIONS) / ITERATIONS * 1e6
+        print(f"{name:<9} {encode_us:>12.1f} {decode_us:>12.1f}", end="")
+        for _, compress in compressors:
+            compressed = compress(body)
+            compress_us = timeit.timeit(lambda: compress(body), number=ITERATIONS // 10) / (ITERATIONS // 10) * 1e6
+            print(f" {len(compressed):>11} {compress_us:>10.1f}", end="")
+        print()
+
+
+if __name__ == "__main__":
+    main()
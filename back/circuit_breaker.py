@@ -0,0 +1,137 @@
+"""
+Health-tracking circuit breaker for model backends.
+
+The breaker trips open when the error rate or the latency percentile over a
+rolling window of recent calls exceeds its thresholds. After a cooldown it
+lets probe calls through (half-open) and closes again once enough of them
+succeed.
+"""
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def percentile(values: list, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window: int = 20,
+        min_calls: int = 5,
+        error_rate_threshold: float = 0.5,
+        latency_percentile: float = 95,
+        latency_threshold_s: Optional[float] = None,
+        cooldown_s: float = 30.0,
+        probe_successes: int = 2,
+    ):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.latency_percentile = latency_percentile
+        self.latency_threshold_s = latency_threshold_s
+        self.cooldown_s = cooldown_s
+        self.probe_successes = probe_successes
+        self._calls = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_streak = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh()
+            return self._state
+
+    def _refresh(self) -> None:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown_s:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+            self._probe_streak = 0
+
+    def _trip(self) -> None:
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self.trips += 1
+
+    def allow_request(self) -> bool:
+        """
+        Whether a call may go to this backend. In half-open state a single
+        probe is let through at a time.
+        """
+        with self._lock:
+            self._refresh()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def release(self) -> None:
+        """Gives back the half-open probe slot of a call that was never dispatched."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self, latency_s: float) -> None:
+        self._record(True, latency_s)
+
+    def record_failure(self, latency_s: float) -> None:
+        self._record(False, latency_s)
+
+    def _record(self, ok: bool, latency_s: float) -> None:
+        with self._lock:
+            slow = self.latency_threshold_s is not None and latency_s > self.latency_threshold_s
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                if ok and not slow:
+                    self._probe_streak += 1
+                    if self._probe_streak >= self.probe_successes:
+                        self._state = CLOSED
+                        self._calls.clear()
+                else:
+                    self._trip()
+                return
+            self._calls.append((ok, latency_s))
+            if self._state == CLOSED and self._unhealthy():
+                self._trip()
+
+    def _unhealthy(self) -> bool:
+        if len(self._calls) < self.min_calls:
+            return False
+        errors = sum(1 for ok, _ in self._calls if not ok)
+        if errors / len(self._calls) >= self.error_rate_threshold:
+            return True
+        if self.latency_threshold_s is not None:
+            p = percentile([latency for _, latency in self._calls], self.latency_percentile)
+            return p > self.latency_threshold_s
+        return False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._refresh()
+            latencies = [latency for _, latency in self._calls]
+            errors = sum(1 for ok, _ in self._calls if not ok)
+            return {
+                "name": self.name,
+                "state": self._state,
+                "trips": self.trips,
+                "window_calls": len(self._calls),
+                "error_rate": errors / len(self._calls) if self._calls else 0.0,
+                "p50_latency_s": percentile(latencies, 50),
+                f"p{self.latency_percentile:g}_latency_s": percentile(latencies, self.latency_percentile),
+            }
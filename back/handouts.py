@@ -0,0 +1,168 @@
+"""
+Handout artifacts produced by ingest_handouts.py.
+
+Each PDF under data/handouts/ is pre-processed into a compact JSON artifact
+(page texts, section headings, text-block bounding boxes, page count), so the
+server and the Gradio interface never parse PDFs on the request path.
+"""
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDOUTS_DIR = os.path.abspath(os.path.join(BASE_DIR, "..", "data", "handouts"))
+ARTIFACTS_DIR = os.path.join(HANDOUTS_DIR, "artifacts")
+MANIFEST_PATH = os.path.join(ARTIFACTS_DIR, "manifest.json")
+# Pre-rendered page images, served as static files under PAGES_URL
+PAGES_DIR = os.path.join(HANDOUTS_DIR, "pages")
+PAGES_URL = "/static/handouts"
+
+DYSPNEE_HANDOUT_ID = "ITEM-R2C_DYSPNEE_AIGUE_ET_CHRONIQUE"
+
+
+def handout_id(filename: str) -> str:
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def artifact_path(handout: str) -> str:
+    return os.path.join(ARTIFACTS_DIR, f"{handout}.json")
+
+
+def pdf_path(handout: str) -> str:
+    return os.path.join(HANDOUTS_DIR, f"{handout}.pdf")
+
+
+def pyramid_dir(handout: str, version: str) -> str:
+    return os.path.join(PAGES_DIR, handout, version)
+
+
+def page_image_name(page: int, level: str, fmt: str, tile: Optional[tuple] = None) -> str:
+    suffix = f"-{tile[0]}-{tile[1]}" if tile else ""
+    return f"p{page}-{level}{suffix}.{fmt}"
+
+
+def page_image_url(handout: str, version: str, name: str) -> str:
+    return f"{PAGES_URL}/{handout}/{version}/{name}"
+
+
+def read_manifest() -> dict:
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def _read_pyramid(entry: dict) -> Optional[dict]:
+    version = entry.get("pyramid")
+    if not version:
+        return None
+    path = os.path.join(pyramid_dir(entry["id"], version), "index.json")
+    if not os.path.exists(path):
+        logger.warning(f"Missing page pyramid index: {path}")
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class HandoutStore:
+    """
+    In-memory view of the ingested handouts, loaded once at startup.
+    """
+    def __init__(self):
+        self.loaded = False
+        self._handouts: Dict[str, dict] = {}
+        self._heading_pages: Dict[str, Dict[str, int]] = {}
+
+    def load(self) -> int:
+        """Loads every artifact listed in the manifest. Returns the number loaded."""
+        handouts = {}
+        for entry in read_manifest().values():
+            path = artifact_path(entry["id"])
+            if not os.path.exists(path):
+                logger.warning(f"Missing handout artifact: {path}")
+                continue
+            with open(path) as f:
+                handouts[entry["id"]] = json.load(f)
+            handouts[entry["id"]]["pyramid"] = _read_pyramid(entry)
+        self._handouts = handouts
+        self._heading_pages = {
+            handout: {h["text"]: h["page"] for h in artifact["headings"]}
+            for handout, artifact in handouts.items()
+        }
+        self.loaded = True
+        logger.info(f"Loaded {len(handouts)} handout artifacts")
+        return len(handouts)
+
+    def ids(self) -> List[str]:
+        return sorted(self._handouts)
+
+    def get(self, handout: str) -> Optional[dict]:
+        return self._handouts.get(handout)
+
+    def headings(self, handout: str) -> List[dict]:
+        artifact = self._handouts.get(handout)
+        return artifact["headings"] if artifact else []
+
+    def page_images(self, handout: str) -> Optional[dict]:
+        """
+        URLs of the pre-rendered images of every page, per resolution level
+        and format, or None if the handout pyramid was not rendered.
+        """
+        artifact = self._handouts.get(handout)
+        pyramid = artifact.get("pyramid") if artifact else None
+        if pyramid is None:
+            return None
+        version = pyramid["version"]
+        pages = []
+        for page in pyramid["pages"]:
+            levels = {
+                level: {
+                    "width": width,
+                    "height": height,
+                    **{fmt: page_image_url(handout, version, page_image_name(page["number"], level, fmt)) for fmt in pyramid["formats"]},
+                }
+                for level, (width, height) in page["levels"].items()
+            }
+            entry = {"number": page["number"], "levels": levels}
+            if page.get("tiles"):
+                cols, rows = page["tiles"]
+                entry["tiles"] = {
+                    "size": pyramid["tile_size"],
+                    "cols": cols,
+                    "rows": rows,
+                    # Fill {row} and {col}
+                    **{fmt: page_image_url(handout, version, page_image_name(page["number"], "zoom", fmt, ("{row}", "{col}"))) for fmt in pyramid["formats"]},
+                }
+            pages.append(entry)
+        return {"id": handout, "version": version, "formats": pyramid["formats"], "pages": pages}
+
+    def page_image_path(self, handout: str, page: int, level: str, fmt: str) -> Optional[str]:
+        """Local path of a pre-rendered page image, if it exists."""
+        artifact = self._handouts.get(handout)
+        pyramid = artifact.get("pyramid") if artifact else None
+        if pyramid is None or fmt not in pyramid["formats"]:
+            return None
+        path = os.path.join(pyramid_dir(handout, pyramid["version"]), page_image_name(page, level, fmt))
+        return path if os.path.exists(path) else None
+
+    def find_page(self, handout: str, text: str) -> Optional[int]:
+        """
+        Page of a section heading, or else of the first page containing text.
+        """
+        page = self._heading_pages.get(handout, {}).get(text)
+        if page is not None:
+            return page
+        artifact = self._handouts.get(handout)
+        if artifact is None:
+            return None
+        needle = text.casefold()
+        for page in artifact["pages"]:
+            if needle in page["text"].casefold():
+                return page["number"]
+        return None
+
+
+handout_store = HandoutStore()
@@ -0,0 +1,285 @@
+"""
+Offline ingestion of the PDF handouts in data/handouts/.
+
+PDFs are processed in parallel worker processes with PyMuPDF. Each one yields
+a compact JSON artifact in data/handouts/artifacts/ and a pyramid of page
+images (thumbnail, screen and zoom widths, optionally zoom tiles) in
+data/handouts/pages/<id>/<version>/, where version is derived from the file
+hash and the render settings so every image URL is immutable. Re-ingestion
+is incremental: a PDF is only processed again when its SHA-256 changes, and
+only re-rendered when that or the render settings change. The previous
+pyramid is kept until the next version replaces it, so servers still
+running with the old index keep serving its images.
+
+Run from back/:
+    python ingest_handouts.py [--workers N] [--force] [--tiles] [--no-render]
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import shutil
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import fitz
+
+from handouts import (
+    ARTIFACTS_DIR,
+    HANDOUTS_DIR,
+    MANIFEST_PATH,
+    PAGES_DIR,
+    artifact_path,
+    handout_id,
+    page_image_name,
+    pyramid_dir,
+    read_manifest,
+)
+
+try:
+    from PIL import Image, features
+    WEBP_AVAILABLE = features.check("webp")
+except ImportError:
+    WEBP_AVAILABLE = False
+
+# A line is a heading candidate when its font is this much larger than the body text
+HEADING_SIZE_RATIO = 1.15
+HEADING_MAX_CHARS = 120
+
+# Width in pixels of each pre-rendered resolution
+PAGE_LEVELS = {"thumb": 240, "screen": 1080, "zoom": 2160}
+TILE_SIZE = 512
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+PAGES_PER_RENDER_JOB = 4
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json(path: str, data) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _font_headings(doc) -> list:
+    """
+    Headings inferred from font size, for PDFs without an outline.
+    """
+    lines = []
+    for page in doc:
+        for block in page.get_text("dict")["blocks"]:
+            for line in block.get("lines", []):
+                spans = [s for s in line["spans"] if s["text"].strip()]
+                if spans:
+                    text = " ".join(s["text"].strip() for s in spans)
+                    lines.append((page.number, max(s["size"] for s in spans), text))
+    if not lines:
+        return []
+    body_size = statistics.median(size for _, size, _ in lines)
+    return [
+        {"text": text, "page": number, "level": 1}
+        for number, size, text in lines
+        if size >= body_size * HEADING_SIZE_RATIO and len(text) <= HEADING_MAX_CHARS
+    ]
+
+
+def extract_handout(path: str, sha256: str) -> dict:
+    """
+    Worker: extracts one PDF and writes its artifact. Returns the manifest entry.
+    """
+    handout = handout_id(path)
+    with fitz.open(path) as doc:
+        pages = []
+        for page in doc:
+            blocks = [
+                [round(x0, 1), round(y0, 1), round(x1, 1), round(y1, 1), text.strip()]
+                for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks")
+                if block_type == 0 and text.strip()
+            ]
+            pages.append({
+                "number": page.number,
+                "width": round(page.rect.width, 1),
+                "height": round(page.rect.height, 1),
+                "text": page.get_text(),
+                "blocks": blocks,
+            })
+        toc = doc.get_toc()
+        if toc:
+            headings = [{"text": title.strip(), "page": number - 1, "level": level} for level, title, number in toc]
+        else:
+            headings = _font_headings(doc)
+        page_count = doc.page_count
+
+    _write_json(artifact_path(handout), {
+        "id": handout,
+        "source": os.path.basename(path),
+        "sha256": sha256,
+        "page_count": page_count,
+        "headings": headings,
+        "pages": pages,
+    })
+    return {"id": handout, "sha256": sha256, "page_count": page_count}
+
+
+def _image_formats() -> list:
+    return ["webp", "jpg"] if WEBP_AVAILABLE else ["jpg"]
+
+
+def _save_pixmap(pix, out_dir: str, number: int, level: str, formats: list, tile: tuple = None) -> None:
+    for fmt in formats:
+        path = os.path.join(out_dir, page_image_name(number, level, fmt, tile))
+        if fmt == "webp":
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            image.save(path, "WEBP", quality=WEBP_QUALITY)
+        else:
+            with open(path, "wb") as f:
+                f.write(pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY))
+
+
+def render_pages(path: str, version: str, numbers: list, tiles: bool) -> list:
+    """
+    Worker: renders the resolution pyramid of some pages of one PDF.
+    Returns the pixel size of each level and the tile grid, per page.
+    """
+    out_dir = pyramid_dir(handout_id(path), version)
+    os.makedirs(out_dir, exist_ok=True)
+    formats = _image_formats()
+    rendered = []
+    with fitz.open(path) as doc:
+        for number in numbers:
+            page = doc[number]
+            levels = {}
+            for level, width in PAGE_LEVELS.items():
+                zoom = width / page.rect.width
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                _save_pixmap(pix, out_dir, number, level, formats)
+                levels[level] = [pix.width, pix.height]
+
+            grid = None
+            if tiles:
+                zoom = PAGE_LEVELS["zoom"] / page.rect.width
+                width, height = levels["zoom"]
+                grid = [math.ceil(width / TILE_SIZE), math.ceil(height / TILE_SIZE)]
+                for row in range(grid[1]):
+                    for col in range(grid[0]):
+                        clip = fitz.Rect(
+                            page.rect.x0 + col * TILE_SIZE / zoom,
+                            page.rect.y0 + row * TILE_SIZE / zoom,
+                            page.rect.x0 + min((col + 1) * TILE_SIZE, width) / zoom,
+                            page.rect.y0 + min((row + 1) * TILE_SIZE, height) / zoom,
+                        )
+                        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+                        _save_pixmap(pix, out_dir, number, "zoom", formats, (row, col))
+            rendered.append({"number": number, "levels": levels, "tiles": grid})
+    return rendered
+
+
+def pyramid_version(sha256: str, tiles: bool) -> str:
+    """Version of the page images, changing with the PDF and with any render setting."""
+    settings = {
+        "levels": PAGE_LEVELS,
+        "tile_size": TILE_SIZE if tiles else None,
+        "jpeg_quality": JPEG_QUALITY,
+        "webp_quality": WEBP_QUALITY,
+        "formats": _image_formats(),
+    }
+    return hashlib.sha256((sha256 + json.dumps(settings, sort_keys=True)).encode()).hexdigest()[:12]
+
+
+def _finish_pyramid(entry: dict, version: str, previous_version: str, pages: list, tiles: bool) -> None:
+    """
+    Writes the pyramid index and removes the versions older than the one it
+    replaces, which running servers may still be pointing to.
+    """
+    os.makedirs(pyramid_dir(entry["id"], version), exist_ok=True)
+    _write_json(os.path.join(pyramid_dir(entry["id"], version), "index.json"), {
+        "id": entry["id"],
+        "version": version,
+        "formats": _image_formats(),
+        "tile_size": TILE_SIZE if tiles else None,
+        "pages": sorted(pages, key=lambda p: p["number"]),
+    })
+    handout_pages_dir = os.path.join(PAGES_DIR, entry["id"])
+    keep = {version, previous_version}
+    for old_version in os.listdir(handout_pages_dir):
+        if old_version not in keep:
+            shutil.rmtree(os.path.join(handout_pages_dir, old_version), ignore_errors=True)
+    entry["pyramid"] = version
+
+
+def ingest(workers: int = None, force: bool = False, render: bool = True, tiles: bool = False) -> dict:
+    """
+    Processes new and changed PDFs, drops artifacts of removed ones and
+    rewrites the manifest. Returns the new manifest.
+    """
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    previous = read_manifest()
+    sources = sorted(f for f in os.listdir(HANDOUTS_DIR) if f.lower().endswith(".pdf"))
+
+    manifest, pending = {}, {}
+    for source in sources:
+        path = os.path.join(HANDOUTS_DIR, source)
+        sha256 = file_sha256(path)
+        entry = previous.get(source)
+        if not force and entry and entry["sha256"] == sha256 and os.path.exists(artifact_path(entry["id"])):
+            manifest[source] = entry
+        else:
+            pending[source] = (path, sha256)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(extract_handout, path, sha256): source for source, (path, sha256) in pending.items()}
+        for future in as_completed(futures):
+            manifest[futures[future]] = future.result()
+            print(f"Ingested {futures[future]}")
+
+        if render:
+            # Pages are rendered in chunks so a single large handout is spread over all workers
+            versions = {source: pyramid_version(entry["sha256"], tiles) for source, entry in manifest.items()}
+            to_render = [source for source, entry in manifest.items() if entry.get("pyramid") != versions[source]]
+            futures = {}
+            for source in to_render:
+                entry = manifest[source]
+                version = versions[source]
+                for first in range(0, entry["page_count"], PAGES_PER_RENDER_JOB):
+                    numbers = list(range(first, min(first + PAGES_PER_RENDER_JOB, entry["page_count"])))
+                    path = os.path.join(HANDOUTS_DIR, source)
+                    futures[pool.submit(render_pages, path, version, numbers, tiles)] = source
+            rendered = {source: [] for source in to_render}
+            for future in as_completed(futures):
+                rendered[futures[future]].extend(future.result())
+            for source, pages in rendered.items():
+                _finish_pyramid(manifest[source], versions[source], previous.get(source, {}).get("pyramid"), pages, tiles)
+                print(f"Rendered {len(pages)} pages of {source}")
+
+    for source, entry in previous.items():
+        if source not in manifest:
+            if os.path.exists(artifact_path(entry["id"])):
+                os.remove(artifact_path(entry["id"]))
+            shutil.rmtree(os.path.join(PAGES_DIR, entry["id"]), ignore_errors=True)
+            print(f"Removed artifacts of {source}")
+
+    _write_json(MANIFEST_PATH, dict(sorted(manifest.items())))
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-process PDF handouts into JSON artifacts and page images")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Re-ingest every PDF, ignoring file hashes")
+    parser.add_argument("--tiles", action="store_true", help="Also cut the zoom level into tiles")
+    parser.add_argument("--no-render", action="store_true", help="Skip the page image pyramid")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    manifest = ingest(workers=args.workers, force=args.force, render=not args.no_render, tiles=args.tiles)
+    print(f"{len(manifest)} handouts up to date in {time.perf_counter() - start:.1f}s")
@@ -1,27 +1,49 @@
 import fitz
 import gradio as gr
 import io
-import pandas as pd
-from PIL import Image
+from PIL import Image, ImageDraw
 
+from handouts import DYSPNEE_HANDOUT_ID, handout_store, pdf_path
 
-df = pd.read_csv('dispnea_chronique_and_aigue.csv')
-text_to_page = {
-    f'{df.iloc[i].Texte}': int(df.iloc[i].Page)
-    for i in range(len(df)) 
-}
-examples = [df.iloc[i].Texte for i in range(len(df))]
+
+# Artifacts are produced by ingest_handouts.py
+handout_store.load()
+headings = handout_store.headings(DYSPNEE_HANDOUT_ID)
+examples = [h["text"] for h in headings]
+
+def highlight_prerendered_page(num_page, text):
+    """
+    Highlights the text blocks containing text on the pre-rendered screen image
+    of the page, or returns None if the page pyramid was not rendered.
+    """
+    path = handout_store.page_image_path(DYSPNEE_HANDOUT_ID, num_page, "screen", "jpg")
+    if path is None:
+        return None
+    page = handout_store.get(DYSPNEE_HANDOUT_ID)["pages"][num_page]
+    img = Image.open(path).convert("RGBA")
+    scale = img.width / page["width"]
+    overlay = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    needle = " ".join(text.split()).casefold()
+    for x0, y0, x1, y1, block_text in page["blocks"]:
+        if needle in " ".join(block_text.split()).casefold():
+            draw.rectangle([x0 * scale, y0 * scale, x1 * scale, y1 * scale], fill=(255, 235, 59, 90))
+    return Image.alpha_composite(img, overlay)
 
 def get_pdf_with_highlight(msg, history):
     try:
         i = int(msg)
-        text = df.iloc[i].Texte
-        num_page = int(df.iloc[i].Page)
-    except:
+        text = headings[i]["text"]
+        num_page = headings[i]["page"]
+    except (ValueError, IndexError):
         text = msg
-        num_page = text_to_page.get(text)
+        num_page = handout_store.find_page(DYSPNEE_HANDOUT_ID, text) or 0
+
+    img = highlight_prerendered_page(num_page, text)
+    if img is not None:
+        return text, img
 
-    doc = fitz.open('ITEM-R2C_DYSPNEE_AIGUE_ET_CHRONIQUE.pdf')
+    doc = fitz.open(pdf_path(DYSPNEE_HANDOUT_ID))
     page = doc[num_page]
 
     # Search for the term and highlight
@@ -0,0 +1,108 @@
+"""
+Process lifecycle: readiness and graceful drain.
+
+The worker reports ready only once startup (preloading, warm-up) is done,
+and stops reporting ready as soon as it starts draining. In-flight jobs
+(streamed turns, report generation) are tracked so shutdown can wait for
+them to finish.
+
+uvicorn closes every open connection (WebSockets with code 1012) before it
+runs the lifespan shutdown, so the drain cannot live there. DrainingServer
+starts it when the exit signal arrives instead: it reports not ready for
+READINESS_GRACE_S while still serving, so load balancers stop routing to
+it, then stops accepting connections and waits for in-flight jobs before
+letting uvicorn close the remaining connections.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+# Seconds in-flight jobs and requests get to finish once the drain starts
+DRAIN_TIMEOUT_S = float(os.getenv("DRAIN_TIMEOUT_S", "60"))
+# Seconds the worker keeps serving while reporting not ready, before it stops accepting connections
+READINESS_GRACE_S = float(os.getenv("READINESS_GRACE_S", "5"))
+
+
+class Lifecycle:
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.started_at = time.time()
+        # Per-step results of the startup warm-up
+        self.warmup: dict = {}
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    @property
+    def in_flight(self) -> int:
+        with self._idle:
+            return self._in_flight
+
+    @contextmanager
+    def job(self):
+        """Marks the enclosed work as in flight until it completes."""
+        with self._idle:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._in_flight -= 1
+                self._idle.notify_all()
+
+    def run_job(self, func: Callable, *args, **kwargs):
+        """Runs func as a tracked job, e.g. from a FastAPI background task."""
+        with self.job():
+            return func(*args, **kwargs)
+
+    def start_draining(self) -> None:
+        self.draining = True
+        self.ready = False
+
+    def wait_idle(self, timeout: float) -> bool:
+        """Blocks until no job is in flight. Returns False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "draining": self.draining,
+            "in_flight": self.in_flight,
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "warmup": self.warmup,
+        }
+
+
+lifecycle = Lifecycle()
+
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn server draining in-flight jobs before connections are closed."""
+    async def shutdown(self, sockets=None) -> None:
+        lifecycle.start_draining()
+        if READINESS_GRACE_S > 0 and not self.force_exit:
+            logger.info(f"Reporting not ready for {READINESS_GRACE_S}s before draining")
+            await asyncio.sleep(READINESS_GRACE_S)
+        # Stop accepting connections; existing ones keep being served
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT_S
+        logger.info(f"Draining {lifecycle.in_flight} in-flight jobs")
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, lifecycle.wait_idle, DRAIN_TIMEOUT_S):
+            logger.warning(f"Closing connections with {lifecycle.in_flight} jobs still in flight")
+        # What is left of the budget goes to HTTP requests still running
+        self.config.timeout_graceful_shutdown = max(deadline - time.monotonic(), 1)
+        await super().shutdown(sockets)
@@ -1,9 +1,15 @@
 import os
-from typing import Optional
+import threading
+import time
+from typing import Any, Iterator, Optional
 from dotenv import load_dotenv
+import google.auth
+import google.auth.transport.requests
 from google import genai
 from google.genai import types
 
+from token_accounting import check_budget, current_tags, ensure_within_budget, record_usage
+
 load_dotenv()
 
 GEMINI_MODEL = "gemini-2.5-flash"
@@ -12,12 +18,120 @@ GEMINI_MODEL = "gemini-2.5-flash"
 SYSTEM = "You are a helpful medical assistant."
 PROMPT = "How do you differentiate bacterial from viral pneumonia?"
 
-def call_gemini(
+CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+_client_lock = threading.Lock()
+# (pid, client): a client and its connections are not reused across fork
+_client_instance: Optional[tuple] = None
+_credentials_lock = threading.Lock()
+# (pid, credentials), shared by the client so the warm-up token fetch is not repeated
+_credentials_instance: Optional[tuple] = None
+
+def google_credentials():
+    """
+    Application Default Credentials of this process, discovered and given an
+    access token on first use. The client refreshes the token itself once it
+    expires.
+    """
+    global _credentials_instance
+    with _credentials_lock:
+        if _credentials_instance is None or _credentials_instance[0] != os.getpid():
+            credentials, _ = google.auth.default(scopes=[CLOUD_PLATFORM_SCOPE])
+            credentials.refresh(google.auth.transport.requests.Request())
+            _credentials_instance = (os.getpid(), credentials)
+        return _credentials_instance[1]
+
+def get_client() -> genai.Client:
+    """Client shared by the calls of this process, created on first use."""
+    global _client_instance
+    with _client_lock:
+        if _client_instance is None or _client_instance[0] != os.getpid():
+            client = genai.Client(
+                vertexai=True,
+                project=os.getenv("GOOGLE_CLOUD_PROJECT"),
+                location="global",
+                credentials=google_credentials(),
+            )
+            _client_instance = (os.getpid(), client)
+        return _client_instance[1]
+
+def _generation_config(
+    max_tokens: int,
+    temperature: float,
+    system_instruction: Optional[str] = None,
+    cached_content: Optional[str] = None,
+    response_schema: Optional[Any] = None,
+    ) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        max_output_tokens=max_tokens,
+        system_instruction=system_instruction,
+        cached_content=cached_content,
+        # Constrains decoding to JSON matching the schema
+        response_mime_type="application/json" if response_schema is not None else None,
+        response_schema=response_schema,
+        safety_settings=[
+            types.SafetySetting(
+                category="HARM_CATEGORY_HATE_SPEECH",
+                threshold="OFF"
+            ),
+            types.SafetySetting(
+                category="HARM_CATEGORY_DANGEROUS_CONTENT",
+                threshold="OFF"
+            ),
+            types.SafetySetting(
+                category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                threshold="OFF"
+            ),
+            types.SafetySetting(
+                category="HARM_CATEGORY_HARASSMENT",
+                threshold="OFF"
+            )
+        ],
+        thinking_config=types.ThinkingConfig(
+            thinking_budget=-1,
+        ),
+    )
+
+def _stream_contents(client, contents, gemini_config, estimated_input_tokens: int, tags: dict) -> Iterator[str]:
+    """
+    Yields the response text chunks, then records token usage and latency.
+    """
+    start = time.perf_counter()
+    usage = None
+    try:
+        for chunk in client.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=gemini_config,
+        ):
+            if chunk.usage_metadata:
+                usage = chunk.usage_metadata
+            if chunk.text:
+                yield chunk.text
+    finally:
+        record_usage(
+            "gemini",
+            estimated_input_tokens,
+            usage.prompt_token_count if usage else None,
+            (usage.candidates_token_count or 0) if usage else 0,
+            (usage.thoughts_token_count or 0) if usage else 0,
+            time.perf_counter() - start,
+            tags,
+        )
+
+def stream_gemini(
     prompt: str = f"{SYSTEM} {PROMPT}",
     max_tokens: int = 4096,
     temperature: float = 0.0,
-    system_prompt: Optional[str] = None
-    ):
+    system_prompt: Optional[str] = None,
+    response_schema: Optional[Any] = None
+    ) -> Iterator[str]:
+    """
+    Streams the Gemini response as text chunks.
+    With response_schema (a Pydantic model), the response is JSON constrained to it.
+    Raises TokenBudgetExceeded before dispatch if the prompt is too large.
+    """
     # Use custom system prompt if provided, otherwise use default
     if system_prompt:
         effective_system = system_prompt
@@ -26,11 +140,8 @@ def call_gemini(
     
     # Combine system prompt with user prompt
     full_prompt = f"{effective_system}\n\n{prompt}"
-    client = genai.Client(
-        vertexai=True,
-        project=os.getenv("GOOGLE_CLOUD_PROJECT"),
-        location="global",
-    )
+    estimated_input_tokens = check_budget("gemini", full_prompt, max_tokens)
+    client = get_client()
 
     contents = [
         types.Content(
@@ -41,47 +152,29 @@ def call_gemini(
         )
     ]
 
-    gemini_config = types.GenerateContentConfig(
-        temperature=temperature,
-        max_output_tokens=max_tokens,
-        safety_settings = [types.SafetySetting(
-            category="HARM_CATEGORY_HATE_SPEECH",
-            threshold="OFF"
-        ),types.SafetySetting(
-            category="HARM_CATEGORY_DANGEROUS_CONTENT",
-            threshold="OFF"
-        ),types.SafetySetting(
-            category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-            threshold="OFF"
-        ),types.SafetySetting(
-            category="HARM_CATEGORY_HARASSMENT",
-            threshold="OFF"
-        )],
-            thinking_config=types.ThinkingConfig(
-            thinking_budget=-1,
-        ),
-    )
+    gemini_config = _generation_config(max_tokens, temperature, response_schema=response_schema)
 
-    full_response = ""
-    for chunk in client.models.generate_content_stream(
-        model=GEMINI_MODEL,
-        contents=contents,
-        config=gemini_config,
-    ):
-        if chunk.text:
-            full_response += chunk.text
+    return _stream_contents(client, contents, gemini_config, estimated_input_tokens, current_tags())
 
+def call_gemini(
+    prompt: str = f"{SYSTEM} {PROMPT}",
+    max_tokens: int = 4096,
+    temperature: float = 0.0,
+    system_prompt: Optional[str] = None,
+    response_schema: Optional[Any] = None
+    ):
+    full_response = "".join(stream_gemini(prompt, max_tokens, temperature, system_prompt, response_schema))
     return full_response.strip()
 
-def call_gemini_with_history(
+def stream_gemini_with_history(
     prompt: str,
     history: list,
     max_tokens: int = 4096,
     temperature: float = 0.0,
     system_prompt: Optional[str] = None
-    ):
+    ) -> Iterator[str]:
     """
-    Call Gemini with conversation history support.
+    Stream Gemini response chunks with conversation history support.
     
     Args:
         prompt: The current user message
@@ -96,11 +189,7 @@ def call_gemini_with_history(
     else:
         effective_system = SYSTEM
     
-    client = genai.Client(
-        vertexai=True,
-        project=os.getenv("GOOGLE_CLOUD_PROJECT"),
-        location="global",
-    )
+    client = get_client()
 
     contents = []
     
@@ -143,6 +232,12 @@ def call_gemini_with_history(
             )
         )
     
+    estimated_input_tokens = check_budget(
+        "gemini",
+        "\n".join(part.text for content in contents for part in content.parts) + prompt,
+        max_tokens,
+    )
+
     # Add current user message
     contents.append(
         types.Content(
@@ -151,42 +246,65 @@ def call_gemini_with_history(
         )
     )
 
-    gemini_config = types.GenerateContentConfig(
-        temperature=temperature,
-        max_output_tokens=max_tokens,
-        safety_settings=[
-            types.SafetySetting(
-                category="HARM_CATEGORY_HATE_SPEECH",
-                threshold="OFF"
-            ),
-            types.SafetySetting(
-                category="HARM_CATEGORY_DANGEROUS_CONTENT",
-                threshold="OFF"
-            ),
-            types.SafetySetting(
-                category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                threshold="OFF"
-            ),
-            types.SafetySetting(
-                category="HARM_CATEGORY_HARASSMENT",
-                threshold="OFF"
-            )
-        ],
-        thinking_config=types.ThinkingConfig(
-            thinking_budget=-1,
+    gemini_config = _generation_config(max_tokens, temperature)
+
+    return _stream_contents(client, contents, gemini_config, estimated_input_tokens, current_tags())
+
+def call_gemini_with_history(
+    prompt: str,
+    history: list,
+    max_tokens: int = 4096,
+    temperature: float = 0.0,
+    system_prompt: Optional[str] = None
+    ):
+    """
+    Call Gemini with conversation history support.
+    Same arguments as stream_gemini_with_history, returns the full response.
+    """
+    full_response = "".join(stream_gemini_with_history(prompt, history, max_tokens, temperature, system_prompt))
+    return full_response.strip()
+
+
+def stream_gemini_contents(
+    contents: list,
+    estimated_input_tokens: int,
+    max_tokens: int = 4096,
+    temperature: float = 0.0,
+    system_instruction: Optional[str] = None,
+    cached_content: Optional[str] = None,
+    ) -> Iterator[str]:
+    """
+    Streams a response to prebuilt contents, for callers that keep the
+    conversation as types.Content and only append to it.
+    The system instruction must be omitted when it lives in cached_content.
+    """
+    ensure_within_budget("gemini", estimated_input_tokens, max_tokens)
+    gemini_config = _generation_config(max_tokens, temperature, system_instruction, cached_content)
+    return _stream_contents(get_client(), contents, gemini_config, estimated_input_tokens, current_tags())
+
+def create_context_cache(system_instruction: str, ttl_s: int) -> str:
+    """
+    Creates an explicit context cache holding system_instruction and returns
+    its name, to be passed as cached_content.
+    """
+    cache = get_client().caches.create(
+        model=GEMINI_MODEL,
+        config=types.CreateCachedContentConfig(
+            system_instruction=system_instruction,
+            ttl=f"{ttl_s}s",
         ),
     )
+    return cache.name
 
-    full_response = ""
-    for chunk in client.models.generate_content_stream(
-        model=GEMINI_MODEL,
-        contents=contents,
-        config=gemini_config,
-    ):
-        if chunk.text:
-            full_response += chunk.text
+def extend_context_cache(name: str, ttl_s: int) -> None:
+    """Resets the time to live of a context cache to ttl_s from now."""
+    get_client().caches.update(
+        name=name,
+        config=types.UpdateCachedContentConfig(ttl=f"{ttl_s}s"),
+    )
 
-    return full_response.strip()
+def delete_context_cache(name: str) -> None:
+    get_client().caches.delete(name=name)
 
 
 if __name__ == "__main__":
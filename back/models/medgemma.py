@@ -1,7 +1,10 @@
 import os
+import time
 from dotenv import load_dotenv
 from google.cloud import aiplatform
 
+from token_accounting import check_budget, estimate_tokens, record_usage
+
 load_dotenv()
 
 # Endpoint setup
@@ -22,6 +25,8 @@ def call_medgemma(
     max_tokens: int = 4096,
     temperature: float = 0.0
     ):
+    # The endpoint does not report usage, so both sides are estimated locally
+    estimated_input_tokens = check_budget("medgemma", prompt, max_tokens)
     instances = [
         {
             "prompt": prompt,
@@ -31,11 +36,20 @@ def call_medgemma(
         },
     ]
 
+    start = time.perf_counter()
     response = endpoint.predict(
         instances=instances,
         use_dedicated_endpoint=USE_DEDICATED_ENDPOINT
     )
     prediction = response.predictions[0]
+    record_usage(
+        "medgemma",
+        estimated_input_tokens,
+        None,
+        estimate_tokens(prediction),
+        0,
+        time.perf_counter() - start,
+    )
     
     return prediction.strip()
 
@@ -0,0 +1,208 @@
+"""
+Model calls with per-backend circuit breakers and automatic failover.
+
+Each backend has a circuit breaker driven by its error rate and latency
+percentile. Calls to an unhealthy backend (breaker open, error or timeout)
+go to its configured fallback instead, and every failover is logged and
+counted.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional, Type
+
+from pydantic import BaseModel
+
+from circuit_breaker import CircuitBreaker
+from models.gemini import call_gemini
+from models.medgemma import call_medgemma
+from token_accounting import TokenBudgetExceeded, input_budget
+
+logger = logging.getLogger(__name__)
+
+
+class BackendUnavailable(RuntimeError):
+    pass
+
+
+class BackendSaturated(BackendUnavailable):
+    pass
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def schema_instructions(response_schema: Type[BaseModel]) -> str:
+    """Text appended to the prompt of backends without constrained decoding."""
+    schema = json.dumps(response_schema.model_json_schema(), separators=(",", ":"))
+    return f"\n\nRespond with a single JSON object matching this JSON schema, and nothing else:\n{schema}"
+
+
+def _call_medgemma(prompt: str, max_tokens: int, temperature: float, system_prompt: Optional[str], response_schema) -> str:
+    # The MedGemma endpoint takes a single prompt and has no constrained decoding
+    if system_prompt:
+        prompt = f"{system_prompt}\n\n{prompt}"
+    if response_schema is not None:
+        prompt += schema_instructions(response_schema)
+    return call_medgemma(prompt=prompt, max_tokens=max_tokens, temperature=temperature)
+
+
+def _call_gemini(prompt: str, max_tokens: int, temperature: float, system_prompt: Optional[str], response_schema) -> str:
+    return call_gemini(
+        prompt=prompt,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        system_prompt=system_prompt,
+        response_schema=response_schema,
+    )
+
+
+BACKENDS = {
+    "gemini": _call_gemini,
+    "medgemma": _call_medgemma,
+}
+
+# Backend used when another one is unhealthy; empty means no failover
+FALLBACKS = {
+    "gemini": os.getenv("GEMINI_FALLBACK", ""),
+    "medgemma": os.getenv("MEDGEMMA_FALLBACK", "gemini"),
+}
+
+# Calls taking longer than this are abandoned and failed over
+TIMEOUTS_S = {
+    "gemini": _env_float("GEMINI_TIMEOUT_S", 120.0),
+    "medgemma": _env_float("MEDGEMMA_TIMEOUT_S", 90.0),
+}
+
+breakers = {
+    name: CircuitBreaker(
+        name,
+        latency_threshold_s=_env_float(f"{name.upper()}_P95_LATENCY_S", 60.0),
+        cooldown_s=_env_float(f"{name.upper()}_COOLDOWN_S", 30.0),
+    )
+    for name in BACKENDS
+}
+
+failovers = Counter()
+_failovers_lock = threading.Lock()
+
+# Calls running on each backend, abandoned ones included. Each backend has its
+# own pool of that size, so a hanging backend never delays its fallback.
+MAX_IN_FLIGHT = {name: int(os.getenv(f"{name.upper()}_MAX_IN_FLIGHT", "8")) for name in BACKENDS}
+_executors = {
+    name: ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT[name], thread_name_prefix=f"{name}-call")
+    for name in BACKENDS
+}
+_slots = {name: threading.BoundedSemaphore(MAX_IN_FLIGHT[name]) for name in BACKENDS}
+
+# Calls given up on after their timeout: still running, and total
+abandoned = {name: {"in_flight": 0, "total": 0} for name in BACKENDS}
+_abandoned_lock = threading.Lock()
+
+
+def _abandon(backend: str, future, start: float) -> None:
+    """Tracks a timed-out call that keeps its thread until the backend answers."""
+    with _abandoned_lock:
+        abandoned[backend]["in_flight"] += 1
+        abandoned[backend]["total"] += 1
+    logger.warning(f"Abandoned {backend} call after {TIMEOUTS_S[backend]}s, it keeps running in the background")
+
+    def finished(_):
+        with _abandoned_lock:
+            abandoned[backend]["in_flight"] -= 1
+        logger.info(f"Abandoned {backend} call finished after {time.perf_counter() - start:.1f}s")
+
+    future.add_done_callback(finished)
+
+
+def _call(backend: str, prompt: str, max_tokens: int, temperature: float, system_prompt: Optional[str], response_schema) -> str:
+    if not _slots[backend].acquire(blocking=False):
+        raise BackendSaturated(f"{backend} already has {MAX_IN_FLIGHT[backend]} calls in flight")
+    start = time.perf_counter()
+    # Run in the caller's context so token usage stays attributed to its session
+    context = contextvars.copy_context()
+    future = _executors[backend].submit(context.run, BACKENDS[backend], prompt, max_tokens, temperature, system_prompt, response_schema)
+    future.add_done_callback(lambda _: _slots[backend].release())
+    try:
+        return future.result(timeout=TIMEOUTS_S[backend])
+    except FutureTimeoutError:
+        _abandon(backend, future, start)
+        raise
+
+
+def call_model(
+    backend: str,
+    prompt: str,
+    max_tokens: int = 4096,
+    temperature: float = 0.0,
+    system_prompt: Optional[str] = None,
+    response_schema: Optional[Type[BaseModel]] = None,
+    failover: bool = True,
+) -> str:
+    """
+    Calls backend through its circuit breaker, failing over to the configured
+    fallback when the backend is open, errors or times out, or when the
+    prompt is too large for backend but fits in the fallback's context.
+    With response_schema, the backend is asked for JSON matching that model,
+    using constrained decoding where supported.
+    """
+    breaker = breakers[backend]
+    if breaker.allow_request():
+        start = time.perf_counter()
+        try:
+            response = _call(backend, prompt, max_tokens, temperature, system_prompt, response_schema)
+            breaker.record_success(time.perf_counter() - start)
+            return response
+        except TokenBudgetExceeded as e:
+            # Rejected before dispatch, says nothing about the backend health
+            breaker.release()
+            fallback = FALLBACKS.get(backend) if failover else None
+            if not fallback or e.estimated > input_budget(fallback, max_tokens):
+                raise
+            reason, error = "over_budget", e
+        except BackendSaturated as e:
+            # Not dispatched: its calls in flight (mostly abandoned ones) fill its pool
+            breaker.release()
+            reason, error = "saturated", e
+        except FutureTimeoutError as e:
+            breaker.record_failure(time.perf_counter() - start)
+            reason, error = "timeout", e
+        except Exception as e:
+            breaker.record_failure(time.perf_counter() - start)
+            reason, error = "error", e
+    else:
+        reason, error = "circuit_open", None
+
+    fallback = FALLBACKS.get(backend) if failover else None
+    if not fallback:
+        if error is not None:
+            raise error
+        raise BackendUnavailable(f"{backend} circuit is open and no fallback is configured")
+
+    logger.warning(f"Failing over from {backend} to {fallback} ({reason}): {error or breaker.state}")
+    with _failovers_lock:
+        failovers[(backend, fallback, reason)] += 1
+    return call_model(fallback, prompt, max_tokens, temperature, system_prompt, response_schema, failover=False)
+
+
+def backend_metrics() -> dict:
+    with _failovers_lock:
+        counts = [
+            {"from": source, "to": target, "reason": reason, "count": count}
+            for (source, target, reason), count in sorted(failovers.items())
+        ]
+    with _abandoned_lock:
+        abandoned_calls = {name: dict(calls) for name, calls in abandoned.items()}
+    return {
+        "backends": {name: breaker.snapshot() for name, breaker in breakers.items()},
+        "failovers": counts,
+        "in_flight_limit": MAX_IN_FLIGHT,
+        "abandoned": abandoned_calls,
+    }
@@ -0,0 +1,135 @@
+"""
+Incremental JSON parsing with repair of truncated output.
+
+Model output is fed chunk by chunk; the parser scans each character once,
+skipping any text or code fence before the first "{", and remembers the last
+position where the object could be closed into valid JSON. A truncated
+response is repaired by cutting back to that position, which drops the value
+being written (a number, string or literal cut mid-way would otherwise look
+complete) and closing the open containers. The top-level key whose value was
+cut is reported as truncated_key, so it can be regenerated.
+"""
+import json
+from typing import Any, Optional, Tuple
+
+
+class IncrementalJSONParser:
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._start = -1
+        self._end = -1
+        # Open containers as [closer, expecting_key]
+        self._stack = []
+        self._in_string = False
+        self._string_is_key = False
+        self._escape = False
+        # Last position where text[start:pos] + closers is valid JSON
+        self._safe_pos = -1
+        self._safe_closers = ""
+        self._string_start = -1
+        # Top-level key whose value is not complete yet
+        self._open_key: Optional[str] = None
+
+    @property
+    def truncated_key(self) -> Optional[str]:
+        return None if self.complete else self._open_key
+
+    @property
+    def complete(self) -> bool:
+        return self._end != -1
+
+    def feed(self, chunk: str) -> None:
+        self._text += chunk
+        self._scan()
+
+    def _closers(self) -> str:
+        return "".join(closer for closer, _ in reversed(self._stack))
+
+    def _mark_safe(self, pos: int) -> None:
+        self._safe_pos = pos
+        self._safe_closers = self._closers()
+
+    def _scan(self) -> None:
+        text = self._text
+        i = self._pos
+        while i < len(text) and self._end == -1:
+            c = text[i]
+            if self._start == -1:
+                if c == "{":
+                    self._start = i
+                    self._stack.append(["}", True])
+                    self._mark_safe(i + 1)
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._string_is_key:
+                        if len(self._stack) == 1:
+                            self._open_key = json.loads(text[self._string_start:i + 1])
+                    else:
+                        self._mark_safe(i + 1)
+                        if len(self._stack) == 1:
+                            self._open_key = None
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+                top = self._stack[-1]
+                self._string_is_key = top[0] == "}" and top[1]
+            elif c in "{[":
+                self._stack.append(["}" if c == "{" else "]", c == "{"])
+                self._mark_safe(i + 1)
+            elif c in "}]":
+                self._stack.pop()
+                if not self._stack:
+                    self._end = i + 1
+                else:
+                    self._mark_safe(i + 1)
+                    if len(self._stack) == 1:
+                        self._open_key = None
+            elif c == ":":
+                self._stack[-1][1] = False
+            elif c == ",":
+                # The value before the comma is complete (numbers and literals end here)
+                if not self._stack[-1][1] or self._stack[-1][0] == "]":
+                    self._mark_safe(i)
+                if len(self._stack) == 1:
+                    self._open_key = None
+                if self._stack[-1][0] == "}":
+                    self._stack[-1][1] = True
+            i += 1
+        self._pos = i
+
+    def result(self) -> Tuple[Optional[Any], bool]:
+        """
+        Returns (value, complete). value is the parsed object, repaired if the
+        text stopped early, or None if nothing usable was found.
+        """
+        if self._start == -1:
+            return None, False
+        if self.complete:
+            try:
+                return json.loads(self._text[self._start:self._end]), True
+            except json.JSONDecodeError:
+                return None, False
+
+        if self._safe_pos == -1:
+            return None, False
+        try:
+            return json.loads(self._text[self._start:self._safe_pos] + self._safe_closers), False
+        except json.JSONDecodeError:
+            return None, False
+
+
+def parse_partial_json(text: str) -> Tuple[Optional[Any], bool, Optional[str]]:
+    """
+    Parses the first JSON object in text, repairing it if truncated.
+    Returns (value, complete, truncated_key).
+    """
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    value, complete = parser.result()
+    return value, complete, parser.truncated_key
@@ -0,0 +1,270 @@
+"""
+Server-side virtual-patient conversations.
+
+The persona is sent once as the system instruction (or held in an explicit
+Gemini context cache when it is large enough), and the conversation is kept
+as prebuilt contents on the server. Each turn only appends the new exchange
+instead of replaying the whole history from the client. Beyond
+VIRTUAL_PATIENT_WINDOW exchanges, the oldest half of the window is folded
+into a running summary, which joins the persona in the system instruction
+(and in the cache, rebuilt when the summary changes).
+
+Sessions live in the memory of one worker process. The frontend reaches them
+over /ws/session, whose connection stays on one worker; the REST endpoints
+need a single worker or sticky routing.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Iterator, List, Optional
+
+from google.genai import types
+
+from models.gemini import (
+    SYSTEM,
+    call_gemini,
+    create_context_cache,
+    delete_context_cache,
+    extend_context_cache,
+    stream_gemini_contents,
+)
+from session_events import record_event
+from token_accounting import accounting_context, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Exchanges (student question + patient answer) kept verbatim
+VIRTUAL_PATIENT_WINDOW = int(os.getenv("VIRTUAL_PATIENT_WINDOW", "12"))
+# Personas at least this large get an explicit context cache (the model minimum is 1024 tokens)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("VIRTUAL_PATIENT_CACHE_MIN_TOKENS", "1024"))
+CONTEXT_CACHE_ENABLED = os.getenv("VIRTUAL_PATIENT_CONTEXT_CACHE", "true").lower() == "true"
+SESSION_IDLE_TIMEOUT_S = int(os.getenv("VIRTUAL_PATIENT_IDLE_TIMEOUT_S", "3600"))
+MAX_SESSIONS = int(os.getenv("VIRTUAL_PATIENT_MAX_SESSIONS", "1000"))
+# A cache with less time to live than this is rebuilt rather than extended
+CACHE_EXPIRY_MARGIN_S = 60
+PATIENT_MAX_TOKENS = 4096
+
+SUMMARY_PROMPT = """Summarize the following consultation between a medical student and a patient in a few sentences, written from the patient's point of view.
+Keep every symptom, fact and answer the patient already gave, so they stay consistent. Do not add anything.
+{previous}
+Consultation:
+{exchanges}
+"""
+
+
+def _content(role: str, text: str) -> types.Content:
+    return types.Content(role=role, parts=[types.Part.from_text(text=text)])
+
+
+class PatientSession:
+    def __init__(self, system_prompt: str, session_id: Optional[str] = None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.system_prompt = system_prompt or SYSTEM
+        self.summary = ""
+        self.last_used = time.monotonic()
+        self.cache_name: Optional[str] = None
+        self._cache_expires_at = 0.0
+        # (student message, patient reply) pairs in the window, and their contents
+        self._exchanges: List[tuple] = []
+        self._contents: List[types.Content] = []
+        self._tokens = 0
+        self._lock = threading.Lock()
+        self._build_cache()
+
+    def seed(self, history: list) -> None:
+        """Loads earlier messages, e.g. when a client resumes an expired session."""
+        pending = None
+        for msg in history:
+            role = msg.role if hasattr(msg, "role") else msg.get("role", "")
+            content = msg.content if hasattr(msg, "content") else msg.get("content", "")
+            if role == "user":
+                pending = content
+            elif pending is not None:
+                self._append(pending, content)
+                pending = None
+        self._slide_window()
+
+    def _append(self, message: str, reply: str) -> None:
+        self._exchanges.append((message, reply))
+        self._contents.append(_content("user", message))
+        self._contents.append(_content("model", reply))
+        self._tokens += estimate_tokens(message) + estimate_tokens(reply)
+
+    def _full_system_instruction(self) -> str:
+        if self.summary:
+            return f"{self.system_prompt}\n\nSummary of the consultation so far:\n{self.summary}"
+        return self.system_prompt
+
+    def _system_instruction(self) -> Optional[str]:
+        # Omitted when it is held in the cache
+        return None if self.cache_name else self._full_system_instruction()
+
+    def _drop_cache(self) -> None:
+        if self.cache_name:
+            try:
+                delete_context_cache(self.cache_name)
+            except Exception:
+                logger.warning(f"Could not delete context cache {self.cache_name}")
+            self.cache_name = None
+
+    def _build_cache(self) -> None:
+        """(Re)creates the cache for the current system instruction, if large enough."""
+        self._drop_cache()
+        system_instruction = self._full_system_instruction()
+        self._system_tokens = estimate_tokens(system_instruction)
+        if not CONTEXT_CACHE_ENABLED or self._system_tokens < CONTEXT_CACHE_MIN_TOKENS:
+            return
+        try:
+            self.cache_name = create_context_cache(system_instruction, SESSION_IDLE_TIMEOUT_S)
+            self._cache_expires_at = time.monotonic() + SESSION_IDLE_TIMEOUT_S
+        except Exception:
+            logger.exception("Could not create a context cache for the virtual patient, sending the persona inline")
+
+    def _refresh_cache(self) -> None:
+        """Keeps the cache alive as long as the session is used."""
+        if not self.cache_name:
+            return
+        remaining = self._cache_expires_at - time.monotonic()
+        if remaining > SESSION_IDLE_TIMEOUT_S / 2:
+            return
+        if remaining > CACHE_EXPIRY_MARGIN_S:
+            try:
+                extend_context_cache(self.cache_name, SESSION_IDLE_TIMEOUT_S)
+                self._cache_expires_at = time.monotonic() + SESSION_IDLE_TIMEOUT_S
+                return
+            except Exception:
+                logger.warning(f"Could not extend context cache {self.cache_name}, rebuilding it")
+        # Expired or about to: a new cache is cheaper than a failed turn
+        self.cache_name = None
+        self._build_cache()
+
+    def _request_contents(self, message: str) -> List[types.Content]:
+        return self._contents + [_content("user", message)]
+
+    def stream_reply(self, message: str) -> Iterator[str]:
+        """
+        Yields the patient reply to message, then records the exchange.
+        """
+        with self._lock:
+            started = time.perf_counter()
+            self.last_used = time.monotonic()
+            self._refresh_cache()
+            estimated = self._tokens + estimate_tokens(message)
+            if not self.cache_name:
+                estimated += self._system_tokens
+            with accounting_context(self.session_id, "virtual_patient"):
+                stream = stream_gemini_contents(
+                    self._request_contents(message),
+                    estimated,
+                    max_tokens=PATIENT_MAX_TOKENS,
+                    system_instruction=self._system_instruction(),
+                    cached_content=self.cache_name,
+                )
+            chunks = []
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+            reply = "".join(chunks).strip()
+            self._append(message, reply)
+            record_event(
+                "turn",
+                session_id=self.session_id,
+                phase="virtual_patient",
+                mode="patient",
+                prompt_chars=len(message),
+                response_chars=len(reply),
+                latency_s=time.perf_counter() - started,
+                message=message,
+                response=reply,
+            )
+            self._slide_window()
+
+    def reply(self, message: str) -> str:
+        return "".join(self.stream_reply(message)).strip()
+
+    def _slide_window(self) -> None:
+        """
+        Once the window is exceeded, folds its oldest half into the running
+        summary, so the summary (and the cache) change every few turns only.
+        Runs after the reply was sent, so a failed summary only leaves the
+        window unfolded until the next turn.
+        """
+        if len(self._exchanges) <= VIRTUAL_PATIENT_WINDOW:
+            return
+        overflow = len(self._exchanges) - VIRTUAL_PATIENT_WINDOW // 2
+        folded = self._exchanges[:overflow]
+        exchanges = "\n".join(f"Student: {q}\nPatient: {a}" for q, a in folded)
+        previous = f"Summary so far:\n{self.summary}\n" if self.summary else ""
+        try:
+            with accounting_context(self.session_id, "virtual_patient_summary"):
+                self.summary = call_gemini(
+                    prompt=SUMMARY_PROMPT.format(previous=previous, exchanges=exchanges),
+                    max_tokens=1024,
+                )
+        except Exception:
+            logger.exception(f"Could not summarize virtual patient session {self.session_id}, retrying next turn")
+            return
+        self._exchanges = self._exchanges[overflow:]
+        self._contents = self._contents[2 * overflow:]
+        self._tokens = sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self._exchanges)
+        self._build_cache()
+
+    def close(self) -> None:
+        self._drop_cache()
+
+
+class PatientSessionStore:
+    """
+    Sessions of this worker process, evicted after SESSION_IDLE_TIMEOUT_S of
+    inactivity or when more than MAX_SESSIONS are open.
+    """
+    def __init__(self):
+        self._sessions: "OrderedDict[str, PatientSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, system_prompt: str, history: Optional[list] = None, session_id: Optional[str] = None) -> PatientSession:
+        session = PatientSession(system_prompt, session_id)
+        if history:
+            session.seed(history)
+        with self._lock:
+            self._sessions[session.session_id] = session
+            evicted = self._evict()
+        for old in evicted:
+            old.close()
+        return session
+
+    def get(self, session_id: str) -> Optional[PatientSession]:
+        """The session, or None if unknown or idle for too long (it is then closed)."""
+        with self._lock:
+            evicted = self._evict()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        for old in evicted:
+            old.close()
+        return session
+
+    def close(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def _evict(self) -> list:
+        now = time.monotonic()
+        evicted = [
+            self._sessions.pop(session_id)
+            for session_id, session in list(self._sessions.items())
+            if now - session.last_used > SESSION_IDLE_TIMEOUT_S
+        ]
+        while len(self._sessions) > MAX_SESSIONS:
+            evicted.append(self._sessions.popitem(last=False)[1])
+        return evicted
+
+
+patient_sessions = PatientSessionStore()
@@ -0,0 +1,152 @@
+"""
+Typed virtual patient persona.
+
+The persona is generated as JSON constrained to VirtualPatientPersona where
+the backend supports it, parsed with repair of truncated output and
+validated. Invalid, missing or cut-off fields are requested again once, on
+their own, and merged into the valid part.
+"""
+import json
+import logging
+import os
+from typing import List, Optional, Set, Tuple
+
+from pydantic import BaseModel, Field, ValidationError, create_model
+
+from models.router import call_model
+from partial_json import parse_partial_json
+from prompts.virtual_patient import PERSONA_PATCH_PROMPT, VIRTUAL_PATIENT_ROLEPLAY_PROMPT
+
+logger = logging.getLogger(__name__)
+
+PERSONA_PATH = "data/checklists/checklist_virtuel.json"
+
+
+class Symptom(BaseModel):
+    description: str
+    onset: str = ""
+    severity: str = ""
+
+
+class VirtualPatientPersona(BaseModel):
+    name: str
+    age: int = Field(ge=0, le=120)
+    sex: str
+    occupation: str = ""
+    chief_complaint: str
+    history_of_present_illness: str
+    symptoms: List[Symptom] = Field(min_length=1)
+    past_medical_history: List[str] = Field(default_factory=list)
+    medications: List[str] = Field(default_factory=list)
+    allergies: List[str] = Field(default_factory=list)
+    social_history: str = ""
+    family_history: List[str] = Field(default_factory=list)
+    vital_signs: List[str] = Field(default_factory=list)
+    examination_findings: List[str] = Field(default_factory=list)
+    demeanor: str = ""
+
+
+class PersonaValidationError(ValueError):
+    pass
+
+
+def validate_persona(data, truncated: Optional[str] = None) -> Tuple[Optional[VirtualPatientPersona], dict, Set[str]]:
+    """
+    Returns (persona, valid fields, failing field names). persona is None
+    when any field fails. truncated is a field whose value was cut off, which
+    fails even if what is left of it validates.
+    """
+    if not isinstance(data, dict):
+        required = {name for name, field in VirtualPatientPersona.model_fields.items() if field.is_required()}
+        return None, {}, required
+    failing = {truncated} & set(VirtualPatientPersona.model_fields)
+    try:
+        persona = VirtualPatientPersona.model_validate(data)
+    except ValidationError as e:
+        failing |= {str(error["loc"][0]) for error in e.errors() if error["loc"]}
+    if not failing:
+        return persona, data, set()
+    valid = {key: value for key, value in data.items() if key in VirtualPatientPersona.model_fields and key not in failing}
+    return None, valid, failing
+
+
+def _patch_model(fields: Set[str]):
+    """Schema restricted to the fields that need to be generated again."""
+    model_fields = VirtualPatientPersona.model_fields
+    return create_model(
+        "VirtualPatientPersonaPatch",
+        **{name: (model_fields[name].annotation, model_fields[name]) for name in sorted(fields)},
+    )
+
+
+def generate_persona(backend: str, prompt: str, max_tokens: int) -> VirtualPatientPersona:
+    """
+    Generates and validates a persona. Fields that fail validation, e.g.
+    because the output was truncated, are regenerated once on their own.
+    """
+    raw = call_model(backend, prompt=prompt, max_tokens=max_tokens, response_schema=VirtualPatientPersona)
+    data, complete, truncated = parse_partial_json(raw)
+    if not complete:
+        logger.warning("Persona output was truncated or malformed, repairing it")
+    persona, valid, failing = validate_persona(data, truncated)
+    if persona is not None:
+        return persona
+
+    logger.warning(f"Regenerating invalid persona fields: {sorted(failing)}")
+    patch_prompt = prompt + "\n\n" + PERSONA_PATCH_PROMPT.format(
+        fields=", ".join(sorted(failing)),
+        persona=json.dumps(valid, ensure_ascii=False),
+    )
+    raw_patch = call_model(backend, prompt=patch_prompt, max_tokens=max_tokens, response_schema=_patch_model(failing))
+    patch, _, truncated = parse_partial_json(raw_patch)
+    merged = {**valid, **{key: value for key, value in (patch or {}).items() if key in failing}}
+    persona, _, failing = validate_persona(merged, truncated)
+    if persona is None:
+        raise PersonaValidationError(f"Persona fields still invalid after retry: {sorted(failing)}")
+    return persona
+
+
+def save_persona(persona: VirtualPatientPersona, path: str = PERSONA_PATH) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(persona.model_dump_json(indent=2))
+
+
+def load_persona(path: str = PERSONA_PATH) -> Optional[VirtualPatientPersona]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return VirtualPatientPersona.model_validate_json(f.read())
+
+
+def persona_system_prompt(persona: VirtualPatientPersona) -> str:
+    """System prompt for the virtual-patient chat, built from a stored persona."""
+    lines = [
+        VIRTUAL_PATIENT_ROLEPLAY_PROMPT,
+        "PATIENT PROFILE",
+        f"- Name: {persona.name}, {persona.age} years old, {persona.sex}",
+    ]
+    if persona.occupation:
+        lines.append(f"- Occupation: {persona.occupation}")
+    lines.append(f"- Reason for consulting: {persona.chief_complaint}")
+    lines.append(f"- Story: {persona.history_of_present_illness}")
+    lines.append("\nPATIENT CONDITION")
+    for symptom in persona.symptoms:
+        details = ", ".join(d for d in (symptom.onset, symptom.severity) if d)
+        lines.append(f"- {symptom.description}" + (f" ({details})" if details else ""))
+    for title, values in (
+        ("Past medical history", persona.past_medical_history),
+        ("Medications", persona.medications),
+        ("Allergies", persona.allergies),
+        ("Family history", persona.family_history),
+        ("Vital signs", persona.vital_signs),
+        ("Examination findings", persona.examination_findings),
+    ):
+        if values:
+            lines.append(f"\n{title}:")
+            lines.extend(f"- {value}" for value in values)
+    if persona.social_history:
+        lines.append(f"\nSocial history: {persona.social_history}")
+    if persona.demeanor:
+        lines.append(f"Demeanor: {persona.demeanor}")
+    return "\n".join(lines)
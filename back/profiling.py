@@ -0,0 +1,256 @@
+"""
+On-demand sampling profiler for live requests.
+
+A request is profiled when it carries the X-Profile header set to
+PROFILING_TOKEN or is picked by the sample rate (PROFILE_SAMPLE_RATE, or
+PUT /profiles/config for this worker). Without PROFILING_TOKEN, only
+PROFILE_SAMPLE_RATE applies and the /profiles endpoints refuse every request. Only the
+paths in PROFILED_PATHS are eligible. While a request is profiled, a
+background thread samples the stacks of the threads serving it every
+PROFILE_INTERVAL_S and the result is written to PROFILE_DIR in folded-stack
+format, readable by flamegraph.pl, speedscope or inferno.
+
+The event loop thread is shared by all async requests, so a profile of an
+async endpoint also contains samples of concurrent requests running on the
+loop. When profiling is off, the cost is a path check per request.
+"""
+import functools
+import hmac
+import inspect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from typing import List, Optional
+
+from serialization import NegotiatedRoute
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_S = float(os.getenv("PROFILE_INTERVAL_S", "0.005"))
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+# At most this many requests are profiled at once per worker
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", "4"))
+PROFILE_HEADER = b"x-profile"
+PROFILED_PATHS = ("/chat", "/handouts", "/patient")
+
+_active: ContextVar[Optional["RequestProfile"]] = ContextVar("active_profile", default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+def _folded_stack(frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class RequestProfile:
+    """Samples the stacks of the threads attached to one request."""
+    def __init__(self, method: str, path: str, interval_s: float = PROFILE_INTERVAL_S):
+        self.profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.method = method
+        self.path = path
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.status: Optional[int] = None
+        self._threads = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name=f"profiler-{self.profile_id}", daemon=True)
+
+    def attach(self, thread_id: int) -> None:
+        with self._lock:
+            self._threads.add(thread_id)
+
+    def detach(self, thread_id: int) -> None:
+        with self._lock:
+            self._threads.discard(thread_id)
+
+    def start(self) -> None:
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._sampler.join()
+        self.duration_s = time.perf_counter() - self._start
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            with self._lock:
+                threads = tuple(self._threads)
+            frames = sys._current_frames()
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.stacks[_folded_stack(frame)] += 1
+            self.samples += 1
+
+    def metadata(self) -> dict:
+        return {
+            "profile_id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_s": round(self.duration_s, 4),
+            "samples": self.samples,
+            "interval_s": self.interval_s,
+            "pid": os.getpid(),
+        }
+
+    def save(self, directory: str = PROFILE_DIR) -> str:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.profile_id}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(directory, f"{self.profile_id}.json"), "w") as f:
+            json.dump(self.metadata(), f)
+        return path
+
+
+class ProfilingConfig:
+    def __init__(self):
+        self.sample_rate = PROFILE_SAMPLE_RATE
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def should_profile(self, scope) -> bool:
+        if not scope["path"].startswith(PROFILED_PATHS):
+            return False
+        requested = any(name == PROFILE_HEADER and authorized(value.decode("latin-1")) for name, value in scope["headers"])
+        return requested or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self._running >= PROFILE_MAX_CONCURRENT:
+                return False
+            self._running += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._running -= 1
+
+
+profiling_config = ProfilingConfig()
+
+
+def authorized(token: Optional[str]) -> bool:
+    """Without PROFILING_TOKEN, header profiling and the /profiles endpoints are disabled."""
+    if not PROFILING_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token, PROFILING_TOKEN)
+
+
+def attach_current_thread() -> Optional[RequestProfile]:
+    profile = _active.get()
+    if profile is not None:
+        profile.attach(threading.get_ident())
+    return profile
+
+
+def _prune(directory: str = PROFILE_DIR) -> None:
+    names = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    for name in names[:max(len(names) - PROFILE_MAX_FILES, 0)]:
+        for ext in (".json", ".folded"):
+            try:
+                os.remove(os.path.join(directory, name[:-len(".json")] + ext))
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the selected requests, response body included."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not profiling_config.should_profile(scope) or not profiling_config.acquire():
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+            await send(message)
+
+        token = _active.set(profile)
+        profile.attach(threading.get_ident())
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profile.stop()
+            _active.reset(token)
+            profiling_config.release()
+            try:
+                path = profile.save()
+                _prune()
+                logger.info(f"Profiled {profile.method} {profile.path} in {profile.duration_s:.3f}s: {path}")
+            except OSError:
+                logger.exception("Could not write profile")
+
+
+class ProfiledRoute(NegotiatedRoute):
+    """
+    Route class attaching the threadpool thread that runs a sync endpoint to
+    the active profile, so it is sampled along with the event loop.
+    """
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = _attaching(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def _attaching(endpoint):
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = attach_current_thread()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.detach(threading.get_ident())
+    return wrapper
+
+
+def list_profiles(limit: int = 100, directory: str = PROFILE_DIR) -> List[dict]:
+    """Newest profiles first, across all workers writing to directory."""
+    if not os.path.isdir(directory):
+        return []
+    names = sorted((name for name in os.listdir(directory) if name.endswith(".json")), reverse=True)
+    profiles = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def profile_path(profile_id: str, directory: str = PROFILE_DIR) -> Optional[str]:
+    path = os.path.join(directory, f"{os.path.basename(profile_id)}.folded")
+    return path if os.path.exists(path) else None
@@ -0,0 +1,112 @@
+import json
+import textwrap
+import threading
+import uuid
+from collections import OrderedDict
+from string import Formatter
+from typing import Dict, Optional
+
+from prompts.phases import PHASE_PROMPTS
+
+# Number of sessions whose serialized checklist is kept in memory
+CHECKLIST_CACHE_SIZE = 1024
+
+
+class CompiledPrompt:
+    """
+    A phase template parsed once into literal chunks and field names,
+    so rendering is a single join instead of a full str.format parse.
+    """
+    __slots__ = ("name", "fields", "_parts")
+
+    def __init__(self, name: str, template: str):
+        self.name = name
+        self._parts = []
+        fields = []
+        for literal, field, _, _ in Formatter().parse(textwrap.dedent(template).strip()):
+            if literal:
+                self._parts.append((True, literal))
+            if field is not None:
+                self._parts.append((False, field))
+                fields.append(field)
+        self.fields = frozenset(fields)
+
+    def render(self, **values) -> str:
+        return "".join(
+            chunk if is_literal else str(values[chunk])
+            for is_literal, chunk in self._parts
+        )
+
+
+def compile_prompts(templates: Dict[str, str]) -> Dict[str, CompiledPrompt]:
+    return {name: CompiledPrompt(name, template) for name, template in templates.items()}
+
+
+COMPILED_PHASE_PROMPTS = compile_prompts(PHASE_PROMPTS)
+
+
+def serialize_checklist(checklist: dict) -> str:
+    """Compact JSON form of the checklist as sent to the models."""
+    return json.dumps(checklist, separators=(",", ":"), ensure_ascii=False)
+
+
+class ChecklistCache:
+    """
+    Serialized checklist per session. The checklist is fixed for the life of a
+    tutoring session, so it is serialized on first use and reused afterwards.
+    """
+    def __init__(self, maxsize: int = CHECKLIST_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        # Used from threadpool threads (WebSocket turns, report jobs)
+        self._lock = threading.Lock()
+
+    def get(self, session_id: Optional[str], checklist: dict) -> str:
+        if not session_id:
+            return serialize_checklist(checklist)
+        with self._lock:
+            cached = self._entries.get(session_id)
+            if cached is not None:
+                self._entries.move_to_end(session_id)
+                return cached
+        serialized = serialize_checklist(checklist)
+        with self._lock:
+            self._entries[session_id] = serialized
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return serialized
+
+    def discard(self, session_id: str) -> None:
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+
+checklist_cache = ChecklistCache()
+
+
+def ensure_session_id(state: dict) -> str:
+    """Returns the session id stored in the state, assigning one if missing."""
+    if not state.get("session_id"):
+        state["session_id"] = uuid.uuid4().hex
+    return state["session_id"]
+
+
+def last_message_content(history: list) -> str:
+    if not history:
+        return ""
+    last = history[-1]
+    return last.get("content", "") if isinstance(last, dict) else last.content
+
+
+def build_phase_prompt(phase: str, state: dict) -> str:
+    """
+    Builds the instruction sent to the tutor for the given phase.
+    The checklist is only serialized for templates that reference it.
+    """
+    template = COMPILED_PHASE_PROMPTS[phase]
+    values = {}
+    if "checklist" in template.fields:
+        values["checklist"] = checklist_cache.get(state.get("session_id"), state.get("checklist", {}))
+    if "last" in template.fields:
+        values["last"] = last_message_content(state.get("history", []))
+    return template.render(**values)
@@ -0,0 +1,37 @@
+PHASE_PROMPTS = {
+    "summary": """
+    <|BEGINING_TUTORING_SESSION|>
+    Given the checklist, open the tutoring session by asking the student to summarize the findings. Do not provide summary by yourself. Do not provide the diagnosis by yourself. Do not provide hints.
+    Checklist: {checklist}
+    """,
+
+    "diff": """
+    You are guiding diagnosis and differential diagnosis. Ask student to provide you with main diagnosis and with 3-5 possible alternative diagnosis and the reasoning behind them. Do not give the examples, do not provide diagnosis by yourself, do not provide student's response.
+    Student reasoning so far: {last}
+    """,
+
+    "lead": """
+    Help student with diagnosis selection. Ask student for the lead and what supports or contradicts it. Do not provide answers.
+    Student reasoning so far: {last}
+    """,
+
+    "alts": """
+    Help student with alternative diagnosis. Ask what that diagnosis may be, and for the reasoning to rule in/out each option.  Do not provide answers.
+    Student reasoning so far: {last}
+    """,
+
+    "errors": """
+    Help student to reflect on biases/errors. Ask him about possible biases, missing evidence. Do not provide answers.
+    Student reasoning so far: {last}
+    """,
+
+    "plan": """
+    Help student with management plan. Ask student about potential tests, treatments, follow-ups and their justification.  Do not provide answers.
+    Student reasoning so far: {last}
+    """,
+
+    "final_feedback": """
+    Reflect briefly on the session and student's answers (no more than 2-3 sentences). If the student did not answer well or did not provide the answer, please highlight the weaknesses. Then thank them and tell them a report and virtual patient will be created next. Give a brief overall feedback as a tutor .
+    Student reasoning so far: {last}
+    """
+}
@@ -0,0 +1,135 @@
+"""
+Serialization of the chat API payloads.
+
+Responses are encoded with orjson (stdlib json as a fallback), or with
+MessagePack when the client sends "Accept: application/msgpack", and
+compressed with brotli or gzip above COMPRESSION_MIN_BYTES. Requests may
+likewise be sent as MessagePack with "Content-Type: application/msgpack".
+"""
+import gzip
+import json
+import os
+from typing import Any, Callable
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _default(obj: Any) -> Any:
+    """
+    Encodes LangChain messages as the compact {"type", "content"} form that
+    the agent accepts back, and other Pydantic models as dicts.
+    """
+    if hasattr(obj, "type") and hasattr(obj, "content"):
+        return {"type": obj.type, "content": obj.content}
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def dumps_json(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads_json(body: bytes) -> Any:
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def dumps_msgpack(payload: Any) -> bytes:
+    return msgpack.packb(payload, default=_default)
+
+
+def loads_msgpack(body: bytes) -> Any:
+    return msgpack.unpackb(body)
+
+
+def compress(body: bytes, accept_encoding: str):
+    """
+    Returns (body, content encoding) using the best encoding the client
+    accepts, leaving small bodies uncompressed.
+    """
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return body, None
+    accepted = {token.split(";")[0].strip() for token in accept_encoding.lower().split(",")}
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+class FastJSONResponse(Response):
+    """JSONResponse rendered with orjson when available."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+
+def encode_response(request: Request, payload: Any, status_code: int = 200) -> Response:
+    """
+    Encodes payload as MessagePack or JSON according to the Accept header and
+    compresses it according to Accept-Encoding.
+    """
+    if msgpack is not None and MSGPACK_MEDIA_TYPE in request.headers.get("accept", ""):
+        body, media_type = dumps_msgpack(payload), MSGPACK_MEDIA_TYPE
+    else:
+        body, media_type = dumps_json(payload), "application/json"
+    body, encoding = compress(body, request.headers.get("accept-encoding", ""))
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+class _MsgPackRequest(Request):
+    """
+    Hands the decoded MessagePack body to the FastAPI body parser, which reads
+    it through json() when the content type says JSON; it is never re-encoded.
+    """
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = loads_msgpack(await self.body())
+        return self._json
+
+
+class NegotiatedRoute(APIRoute):
+    """
+    Route class accepting MessagePack request bodies in addition to JSON.
+    """
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            if msgpack is not None and request.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE):
+                scope = dict(request.scope)
+                scope["headers"] = [
+                    (name, b"application/json" if name == b"content-type" else value)
+                    for name, value in request.scope["headers"]
+                ]
+                request = _MsgPackRequest(scope, request.receive)
+            return await handler(request)
+
+        return route_handler
@@ -0,0 +1,85 @@
+"""
+Production entrypoint: gunicorn master with uvicorn workers.
+
+The app, prompts and handout artifacts are loaded once in the master before
+fork (preload_app), and the resulting objects are frozen out of the garbage
+collector so workers share that memory copy-on-write. Each worker keeps its
+own caches (checklists, token ledger, circuit breakers), nothing is shared at
+runtime. On SIGTERM workers report not ready for READINESS_GRACE_S seconds,
+then stop accepting connections and let in-flight WebSocket turns, requests
+and report jobs finish for up to DRAIN_TIMEOUT_S seconds before closing the
+remaining connections (see lifecycle.DrainingServer).
+
+Run from back/:
+    python serve.py [--workers N] [--bind 0.0.0.0:8000]
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import sys
+
+# gRPC (used by the Vertex AI clients) must be told before import that the process will fork
+os.environ.setdefault("GRPC_ENABLE_FORK_SUPPORT", "true")
+
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from uvicorn.workers import UvicornWorker
+
+from lifecycle import DRAIN_TIMEOUT_S, READINESS_GRACE_S, DrainingServer
+
+
+def default_workers() -> int:
+    return int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    """UvicornWorker running DrainingServer, so SIGTERM drains before closing connections."""
+    async def _serve(self) -> None:
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+class ProductionServer(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import server
+
+        server.preload()
+        # Objects loaded so far are never collected; keeps GC from touching (and copying) shared pages
+        gc.freeze()
+        return server.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with several worker processes")
+    parser.add_argument("--workers", type=int, default=default_workers(), help="Worker processes (default: WEB_CONCURRENCY or CPU count)")
+    parser.add_argument("--bind", default=os.getenv("BIND", "0.0.0.0:8000"))
+    args = parser.parse_args()
+
+    ProductionServer({
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": DrainingUvicornWorker,
+        "preload_app": True,
+        # Workers get this long to drain after SIGTERM before being killed
+        "graceful_timeout": int(READINESS_GRACE_S + DRAIN_TIMEOUT_S) + 5,
+        "timeout": int(os.getenv("WORKER_TIMEOUT_S", "180")),
+        "keepalive": 5,
+        "accesslog": "-",
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,29 @@
+import asyncio
 import os
 import fitz
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Request
 from fastapi import BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Any, Dict, List, Optional
 from agent import step_agent
 from agent import generate_and_store_report_and_patient
+from websocket_sessions import router as websocket_router
+from token_accounting import TokenBudgetExceeded, accounting_context, ledger
+from models.router import backend_metrics
+from models.gemini import call_gemini, call_gemini_with_history
+from handouts import DYSPNEE_HANDOUT_ID, PAGES_DIR, PAGES_URL, handout_store, pdf_path
+from serialization import FastJSONResponse, encode_response
+from profiling import ProfiledRoute, ProfilingMiddleware, authorized, list_profiles, profile_path, profiling_config
+from lifecycle import DrainingServer, lifecycle
+from warmup import warm_up
+from patient_sessions import patient_sessions
+from session_events import session_events
+from persona import load_persona, persona_system_prompt
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 import logging
 from io import BytesIO
@@ -20,7 +35,39 @@ from prompts.system_tutor import SYTEM_TUTOR_PROMPT
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+def preload():
+    """
+    Loads everything workers only read. Called in the master process before
+    fork by serve.py, so the memory is shared copy-on-write.
+    """
+    # Handouts are pre-processed by ingest_handouts.py; only their artifacts are loaded here
+    if not handout_store.loaded:
+        handout_store.load()
+
+async def _warm_up_then_ready():
+    """Runs the warm-up off the event loop; /ready reports 503 until it is done."""
+    try:
+        lifecycle.warmup = await run_in_threadpool(warm_up)
+    finally:
+        lifecycle.ready = not lifecycle.draining
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    preload()
+    # The worker serves liveness checks while warming up, but is not ready yet
+    warmup_task = asyncio.create_task(_warm_up_then_ready())
+    yield
+    # In-flight jobs were drained by DrainingServer before connections were closed
+    lifecycle.start_draining()
+    warmup_task.cancel()
+    # Writes the session events still queued
+    await run_in_threadpool(session_events.close, 10)
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+# Chat routes also accept MessagePack bodies; sync endpoints can be profiled on their worker thread
+app.router.route_class = ProfiledRoute
+# Profiles requests carrying X-Profile, or a sampled fraction of them
+app.add_middleware(ProfilingMiddleware)
 
 # Allow CORS for local frontend development
 app.add_middleware(
@@ -31,6 +78,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.include_router(websocket_router)
+
+class ImmutableStaticFiles(StaticFiles):
+    """
+    Static files whose URLs change with their content, so clients may cache them forever.
+    """
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+# Page image pyramids rendered by ingest_handouts.py, under a content-hash version directory
+os.makedirs(PAGES_DIR, exist_ok=True)
+app.mount(PAGES_URL, ImmutableStaticFiles(directory=PAGES_DIR), name="handout-pages")
+
+@app.exception_handler(TokenBudgetExceeded)
+async def token_budget_exceeded_handler(request, exc: TokenBudgetExceeded):
+    logger.warning(f"Rejected over-budget request: {exc}")
+    return JSONResponse(
+        status_code=413,
+        content={"detail": str(exc), "estimated_tokens": exc.estimated, "budget": exc.limit},
+    )
+
 class Message(BaseModel):
     role: str
     content: str
@@ -45,13 +115,36 @@ class ChatResponse(BaseModel):
     ai_message: str
     state: Dict[str, Any]
 
+class PatientSessionRequest(BaseModel):
+    system_prompt: str = Field(default="You are a helpful medical assistant.", description="Virtual patient persona")
+    history: Optional[List[Message]] = Field(default=None, description="Earlier messages, when resuming a conversation")
+    from_persona: bool = Field(default=False, description="Use the last generated persona instead of system_prompt")
+
+class ProfilingConfigRequest(BaseModel):
+    sample_rate: float = Field(ge=0, le=1, description="Fraction of eligible requests profiled by this worker")
+
+class PatientSessionResponse(BaseModel):
+    session_id: str
+
+class PatientMessageRequest(BaseModel):
+    message: str
+
+class PatientMessageResponse(BaseModel):
+    session_id: str
+    ai_message: str
+
 @app.get("/")
 def read_root():
     logger.info("=== ROOT ENDPOINT ACCESSED ===")
     return {"message": "API is running"}
 
+@app.get("/ready")
+def readiness():
+    """Ready once startup and warm-up are done, not ready while draining."""
+    return JSONResponse(status_code=200 if lifecycle.ready else 503, content=lifecycle.status())
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(chat_request: ChatRequest, background_tasks: BackgroundTasks):
+def chat_endpoint(chat_request: ChatRequest, background_tasks: BackgroundTasks, request: Request):
     #chat_request.system_prompt = SYTEM_TUTOR_PROMPT
     logger.info("=== CHAT REQUEST ===")
     logger.info(f"Message: {chat_request.message}")
@@ -65,18 +158,16 @@ async def chat_endpoint(chat_request: ChatRequest, background_tasks: BackgroundT
     logger.info(f"Updated State: {result['state']}")
 
     if result["state"].get("phase") == "outputs":
-        background_tasks.add_task(generate_and_store_report_and_patient, result["state"])
+        background_tasks.add_task(lifecycle.run_job, generate_and_store_report_and_patient, result["state"])
     
-    return ChatResponse(ai_message=result["ai_message"], state=result["state"])
+    return encode_response(request, {"ai_message": result["ai_message"], "state": result["state"]})
 
 @app.post("/chat/simple", response_model=ChatResponse)
-async def simple_chat_endpoint(chat_request: ChatRequest):
+def simple_chat_endpoint(chat_request: ChatRequest, request: Request):
     """
     Simple chat endpoint that bypasses the complex agent workflow and just uses Gemini directly.
     Perfect for clean conversations with custom system prompts.
     """
-    from models.gemini import call_gemini_with_history
-    
     logger.info("=== SIMPLE CHAT REQUEST ===")
     logger.info(f"Message: {chat_request.message}")
     logger.info(f"System Prompt: {chat_request.system_prompt}")
@@ -84,28 +175,62 @@ async def simple_chat_endpoint(chat_request: ChatRequest):
     logger.info(f"History: {chat_request.history}")
     
     # Use Gemini with conversation history
-    response = call_gemini_with_history(
-        prompt=chat_request.message,
-        system_prompt=chat_request.system_prompt,
-        history=chat_request.history or []
-    )
+    with accounting_context(chat_request.state.get("session_id"), "virtual_patient"):
+        response = call_gemini_with_history(
+            prompt=chat_request.message,
+            system_prompt=chat_request.system_prompt,
+            history=chat_request.history or []
+        )
     
     logger.info("=== SIMPLE CHAT RESPONSE ===")
     logger.info(f"AI Message: {response}")
     
-    return ChatResponse(
-        ai_message=response, 
-        state=chat_request.state
-    )
+    return encode_response(request, {"ai_message": response, "state": chat_request.state})
+
+@app.post("/patient/sessions", response_model=PatientSessionResponse)
+def create_patient_session(session_request: PatientSessionRequest):
+    """
+    Starts a server-side virtual-patient conversation. The persona is sent to
+    the model once and following turns only carry the new message.
+    """
+    system_prompt = session_request.system_prompt
+    if session_request.from_persona:
+        persona = load_persona()
+        if persona is None:
+            raise HTTPException(status_code=404, detail="No virtual patient persona generated yet")
+        system_prompt = persona_system_prompt(persona)
+    session = patient_sessions.create(system_prompt, session_request.history)
+    logger.info(f"=== PATIENT SESSION {session.session_id} ===")
+    return PatientSessionResponse(session_id=session.session_id)
+
+@app.get("/patient/persona")
+def get_patient_persona(request: Request):
+    """Last virtual patient persona generated at the end of a tutor session."""
+    persona = load_persona()
+    if persona is None:
+        raise HTTPException(status_code=404, detail="No virtual patient persona generated yet")
+    return encode_response(request, persona.model_dump())
+
+@app.post("/patient/sessions/{session_id}/messages", response_model=PatientMessageResponse)
+def patient_message(session_id: str, message_request: PatientMessageRequest, request: Request):
+    session = patient_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired patient session")
+    response = session.reply(message_request.message)
+    return encode_response(request, {"session_id": session_id, "ai_message": response})
+
+@app.delete("/patient/sessions/{session_id}")
+def close_patient_session(session_id: str):
+    if not patient_sessions.close(session_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired patient session")
+    return {"session_id": session_id, "closed": True}
 
 @app.post("/chat/test", response_model=ChatResponse)
-async def test_custom_system_prompt(chat_request: ChatRequest):
+def test_custom_system_prompt(chat_request: ChatRequest, request: Request):
     """
     Test endpoint to demonstrate custom system prompt functionality.
     This endpoint bypasses the complex agent workflow and directly calls Gemini.
     """
-    from models.gemini import call_gemini
-    
     logger.info("=== TEST CHAT REQUEST ===")
     logger.info(f"Message: {chat_request.message}")
     logger.info(f"System Prompt: {chat_request.system_prompt}")
@@ -120,16 +245,88 @@ async def test_custom_system_prompt(chat_request: ChatRequest):
     logger.info("=== TEST CHAT RESPONSE ===")
     logger.info(f"AI Message: {response}")
     
-    return ChatResponse(
-        ai_message=response, 
-        state=chat_request.state
-    )
+    return encode_response(request, {"ai_message": response, "state": chat_request.state})
+
+@app.get("/metrics/tokens")
+def get_token_metrics():
+    """Token usage and latency aggregated per model."""
+    return ledger.summary()
+
+@app.get("/metrics/tokens/{session_id}")
+def get_session_token_metrics(session_id: str):
+    """Token usage and latency of one session, per phase."""
+    summary = ledger.session_summary(session_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    return summary
+
+@app.get("/metrics/backends")
+def get_backend_metrics():
+    """Circuit breaker state, error rate and latency percentiles of each backend, and failover counts."""
+    return backend_metrics()
+
+def require_profiling_token(request: Request):
+    if not authorized(request.headers.get("x-profile")):
+        raise HTTPException(status_code=403, detail="Missing or invalid X-Profile token")
+
+@app.get("/profiles", dependencies=[Depends(require_profiling_token)])
+def get_profiles(limit: int = 100):
+    """Recent request profiles, newest first."""
+    return {"sample_rate": profiling_config.sample_rate, "profiles": list_profiles(limit)}
+
+@app.get("/profiles/{profile_id}", dependencies=[Depends(require_profiling_token)])
+def get_profile(profile_id: str):
+    """Folded stacks of one profile, for flamegraph.pl, speedscope or inferno."""
+    path = profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    return FileResponse(path, media_type="text/plain")
+
+@app.put("/profiles/config", dependencies=[Depends(require_profiling_token)])
+def set_profiling_config(config_request: ProfilingConfigRequest):
+    """Changes the sample rate of the worker handling this request."""
+    profiling_config.sample_rate = config_request.sample_rate
+    return {"sample_rate": profiling_config.sample_rate, "pid": os.getpid()}
+
+@app.get("/handouts")
+def list_handouts():
+    """Ingested handouts with their page count"""
+    return [
+        {"id": handout, "page_count": handout_store.get(handout)["page_count"]}
+        for handout in handout_store.ids()
+    ]
+
+@app.get("/handouts/{handout_id}/outline")
+def get_handout_outline(handout_id: str):
+    """Section headings of an ingested handout, with their page numbers"""
+    artifact = handout_store.get(handout_id)
+    if artifact is None:
+        raise HTTPException(status_code=404, detail="Handout not found")
+    return {"id": handout_id, "page_count": artifact["page_count"], "headings": artifact["headings"]}
+
+@app.get("/handouts/{handout_id}/pages")
+def get_handout_pages(handout_id: str):
+    """
+    URLs of the pre-rendered page images (thumb, screen, zoom and optional zoom
+    tiles, in WebP and JPEG), so clients only download the resolution they display.
+    """
+    pages = handout_store.page_images(handout_id)
+    if pages is None:
+        raise HTTPException(status_code=404, detail="No rendered pages for this handout")
+    return pages
 
 @app.get("/handouts/dyspnee-image")
-def get_dyspnee_image():
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    pdf_path = os.path.abspath(os.path.join(base_dir, "..", "data", "handouts", "ITEM-R2C_DYSPNEE_AIGUE_ET_CHRONIQUE.pdf"))
-    doc = fitz.open(pdf_path)
+def get_dyspnee_image(request: Request):
+    # Prefer the pre-rendered screen image; render on the fly only if ingestion has not run
+    images = handout_store.page_images(DYSPNEE_HANDOUT_ID)
+    if images is not None:
+        screen = images["pages"][0]["levels"]["screen"]
+        accepts_webp = "image/webp" in request.headers.get("accept", "")
+        return RedirectResponse(
+            screen["webp"] if accepts_webp and "webp" in screen else screen["jpg"],
+            headers={"Vary": "Accept"},
+        )
+    doc = fitz.open(pdf_path(DYSPNEE_HANDOUT_ID))
     page = doc.load_page(0)
     pix = page.get_pixmap(dpi=150)
     img_bytes = BytesIO(pix.tobytes("jpeg"))
@@ -138,20 +335,17 @@ def get_dyspnee_image():
 @app.get("/handouts/dyspnee")
 def get_dyspnee_pdf():
     """Serve the PDF file directly"""
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    pdf_path = os.path.abspath(os.path.join(base_dir, "..", "data", "handouts", "ITEM-R2C_DYSPNEE_AIGUE_ET_CHRONIQUE.pdf"))
+    path = pdf_path(DYSPNEE_HANDOUT_ID)
     
-    if not os.path.exists(pdf_path):
+    if not os.path.exists(path):
         raise HTTPException(status_code=404, detail="PDF file not found")
     
-    with open(pdf_path, "rb") as f:
-        pdf_content = f.read()
-    
-    return StreamingResponse(
-        BytesIO(pdf_content), 
+    return FileResponse(
+        path,
         media_type="application/pdf",
-        headers={"Content-Disposition": "inline; filename=ITEM-R2C_DYSPNEE_AIGUE_ET_CHRONIQUE.pdf"}
+        headers={"Content-Disposition": f"inline; filename={DYSPNEE_HANDOUT_ID}.pdf"}
     )
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Single-process development server; see serve.py for production
+    DrainingServer(uvicorn.Config(app, host="0.0.0.0", port=8000)).run()
\ No newline at end of file
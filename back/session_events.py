@@ -0,0 +1,236 @@
+"""
+Append-only store of session events, for cohort analytics.
+
+Tutor and patient turns, model calls and generated outputs are recorded as
+flat events (session, phase, message sizes, tokens, latency). They are
+queued without blocking the request and written by a background thread in
+batches of EVENTS_BATCH_SIZE, or every EVENTS_FLUSH_INTERVAL_S, as new
+Parquet files under EVENTS_DIR/date=YYYY-MM-DD/. Files are never rewritten,
+so several workers can write to the same directory.
+
+load_events and session_summary read the files with pyarrow.dataset, which
+prunes partitions and columns and scans in batches, so summaries over
+thousands of sessions do not load every event into memory.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+from typing import Iterable, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+EVENTS_DIR = os.getenv("EVENTS_DIR", "data/events")
+EVENTS_BATCH_SIZE = int(os.getenv("EVENTS_BATCH_SIZE", "500"))
+EVENTS_FLUSH_INTERVAL_S = float(os.getenv("EVENTS_FLUSH_INTERVAL_S", "30"))
+# Events beyond this many waiting to be written are dropped rather than blocking requests
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "10000"))
+# Message and reply texts are only stored when enabled; sizes always are
+EVENTS_STORE_TEXT = os.getenv("EVENTS_STORE_TEXT", "false").lower() == "true"
+
+if pa is not None:
+    EVENT_SCHEMA = pa.schema([
+        ("event_time", pa.timestamp("ms", tz="UTC")),
+        # "turn", "model_call" or "output"
+        ("event_type", pa.string()),
+        ("session_id", pa.string()),
+        ("phase", pa.string()),
+        # "tutor" or "patient" for turns, "report" or "virtual_patient" for outputs
+        ("mode", pa.string()),
+        ("model", pa.string()),
+        ("prompt_chars", pa.int64()),
+        ("response_chars", pa.int64()),
+        ("estimated_input_tokens", pa.int64()),
+        ("input_tokens", pa.int64()),
+        ("output_tokens", pa.int64()),
+        ("thinking_tokens", pa.int64()),
+        ("latency_s", pa.float64()),
+        ("message", pa.string()),
+        ("response", pa.string()),
+        ("pid", pa.int32()),
+    ])
+    PARTITIONING = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+
+_STOP = object()
+
+
+class SessionEventStore:
+    def __init__(self, directory: str = EVENTS_DIR):
+        self.directory = directory
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def record(self, event_type: str, **fields) -> None:
+        """Queues one event; returns immediately."""
+        if pa is None:
+            return
+        if not EVENTS_STORE_TEXT:
+            fields.pop("message", None)
+            fields.pop("response", None)
+        event = {"event_time": datetime.now(timezone.utc), "event_type": event_type, "pid": os.getpid(), **fields}
+        try:
+            self._writer_queue().put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer_queue(self) -> queue.Queue:
+        # Started lazily in each process: threads do not survive the fork of preloaded workers
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+                    self._thread = threading.Thread(target=self._run, args=(self._queue,), name="session-events", daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def _run(self, events: queue.Queue) -> None:
+        batch = []
+        deadline = time.monotonic() + EVENTS_FLUSH_INTERVAL_S
+        while True:
+            try:
+                event = events.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                event = None
+            if event is _STOP:
+                self._flush(batch)
+                return
+            if event is not None:
+                batch.append(event)
+            if len(batch) >= EVENTS_BATCH_SIZE or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + EVENTS_FLUSH_INTERVAL_S
+
+    def _flush(self, batch: list) -> None:
+        if not batch:
+            return
+        by_date = {}
+        for event in batch:
+            by_date.setdefault(event["event_time"].date().isoformat(), []).append(event)
+        for day, events in by_date.items():
+            partition = os.path.join(self.directory, f"date={day}")
+            name = f"part-{time.time_ns()}-{os.getpid()}-{uuid.uuid4().hex[:6]}.parquet"
+            try:
+                os.makedirs(partition, exist_ok=True)
+                table = pa.Table.from_pylist(events, schema=EVENT_SCHEMA)
+                # Written under a temporary name so readers never see a partial file
+                tmp_path = os.path.join(partition, f".{name}.tmp")
+                pq.write_table(table, tmp_path, compression="zstd")
+                os.replace(tmp_path, os.path.join(partition, name))
+            except Exception:
+                logger.exception(f"Could not write {len(events)} session events")
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Writes the queued events and stops the writer thread of this process."""
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                return
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._pid = None
+        if self.dropped:
+            logger.warning(f"{self.dropped} session events were dropped because the queue was full")
+
+
+session_events = SessionEventStore()
+
+
+def record_event(event_type: str, **fields) -> None:
+    session_events.record(event_type, **fields)
+
+
+def events_dataset(directory: str = EVENTS_DIR):
+    return ds.dataset(directory, format="parquet", schema=EVENT_SCHEMA, partitioning=PARTITIONING)
+
+
+def _filter(session_ids: Optional[Iterable[str]], event_types: Optional[Iterable[str]], start: Optional[date], end: Optional[date]):
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field("date") >= start.isoformat())
+    if end is not None:
+        conditions.append(ds.field("date") <= end.isoformat())
+    if session_ids is not None:
+        conditions.append(ds.field("session_id").isin(list(session_ids)))
+    if event_types is not None:
+        conditions.append(ds.field("event_type").isin(list(event_types)))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def load_events(
+    columns: Optional[list] = None,
+    session_ids: Optional[Iterable[str]] = None,
+    event_types: Optional[Iterable[str]] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    directory: str = EVENTS_DIR,
+):
+    """
+    Events matching the filters as a pandas DataFrame. Only the requested
+    columns and the date partitions between start and end are read.
+    """
+    table = events_dataset(directory).to_table(columns=columns, filter=_filter(session_ids, event_types, start, end))
+    return table.to_pandas()
+
+
+def session_summary(start: Optional[date] = None, end: Optional[date] = None, directory: str = EVENTS_DIR):
+    """
+    One row per session: turns, model calls, tokens, latency and time span.
+    Events are aggregated batch by batch, so memory grows with the number of
+    sessions rather than events.
+    """
+    import pandas as pd
+
+    columns = ["session_id", "event_type", "event_time", "input_tokens", "output_tokens", "thinking_tokens", "latency_s"]
+    partials = []
+    for batch in events_dataset(directory).to_batches(columns=columns, filter=_filter(None, None, start, end)):
+        df = batch.to_pandas()
+        if df.empty:
+            continue
+        df["turns"] = (df["event_type"] == "turn").astype(int)
+        df["model_calls"] = (df["event_type"] == "model_call").astype(int)
+        df["turn_latency_s"] = df["latency_s"].where(df["event_type"] == "turn", 0.0)
+        df["model_latency_s"] = df["latency_s"].where(df["event_type"] == "model_call", 0.0)
+        partials.append(df.groupby("session_id").agg(
+            turns=("turns", "sum"),
+            model_calls=("model_calls", "sum"),
+            input_tokens=("input_tokens", "sum"),
+            output_tokens=("output_tokens", "sum"),
+            thinking_tokens=("thinking_tokens", "sum"),
+            turn_latency_s=("turn_latency_s", "sum"),
+            model_latency_s=("model_latency_s", "sum"),
+            first_event=("event_time", "min"),
+            last_event=("event_time", "max"),
+        ))
+        # Keeps the partial results bounded by the number of sessions
+        if len(partials) >= 16:
+            partials = [_combine(pd.concat(partials))]
+    if not partials:
+        return pd.DataFrame()
+    summary = _combine(pd.concat(partials))
+    summary["duration_s"] = (summary["last_event"] - summary["first_event"]).dt.total_seconds()
+    return summary
+
+
+def _combine(partials):
+    grouped = partials.groupby(level=0)
+    combined = grouped[["turns", "model_calls", "input_tokens", "output_tokens", "thinking_tokens", "turn_latency_s", "model_latency_s"]].sum()
+    combined["first_event"] = grouped["first_event"].min()
+    combined["last_event"] = grouped["last_event"].max()
+    return combined
@@ -0,0 +1,48 @@
+"""
+Tests of the transcript compaction used by the report and persona prompts.
+"""
+from token_accounting import check_budget, compact_messages, estimate_tokens, input_budget, render_messages
+
+MAX_TOKENS = 4096
+
+
+def _french_transcript(turns: int = 400):
+    messages = []
+    for i in range(turns):
+        messages.append(
+            f"Étudiant {i} : la patiente présente une dyspnée d'effort évoluant depuis "
+            f"trois semaines, avec œdème des membres inférieurs.\nJe pense à une décompensation cardiaque."
+        )
+        messages.append(
+            f"Tuteur {i} : très bien. Quels éléments de l'examen clinique et quels \"examens "
+            f"complémentaires\" demanderiez-vous en priorité ?\n- ECG\n- BNP\n- échographie"
+        )
+    return messages
+
+
+def test_compacted_transcript_passes_budget():
+    messages = _french_transcript()
+    prompt = "Generate a final session report in plain text."
+    budget = input_budget("medgemma", MAX_TOKENS) - estimate_tokens(prompt)
+    compacted = compact_messages(messages, budget)
+    assert len(compacted) < len(messages)
+    assert compacted[0] == messages[0]
+    assert compacted[-1] == messages[-1]
+    assert compacted[1] == f"[... {len(messages) - len(compacted) + 1} earlier messages omitted ...]"
+    check_budget("medgemma", render_messages(compacted) + prompt, MAX_TOKENS)
+
+
+def test_rendered_transcript_keeps_accents():
+    assert "é" in render_messages(_french_transcript(1))
+
+
+def test_short_transcript_is_unchanged():
+    messages = _french_transcript(2)
+    assert compact_messages(messages, input_budget("medgemma", MAX_TOKENS)) == messages
+
+
+def test_oversized_opening_is_dropped():
+    messages = ["long " * 2000, "question", "answer"]
+    compacted = compact_messages(messages, 50)
+    assert compacted == ["[... 1 earlier messages omitted ...]", "question", "answer"]
+    assert estimate_tokens(render_messages(compacted)) <= 50
@@ -0,0 +1,236 @@
+"""
+Token accounting for model calls.
+
+Input size is estimated locally before dispatch so over-budget requests can be
+rejected or compacted, and the actual usage and latency of every call is
+aggregated per session and per phase, and appended to the session event
+store.
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+from session_events import record_event
+
+# Context window of each backend, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gemini": int(os.getenv("GEMINI_CONTEXT_TOKENS", "1048576")),
+    "medgemma": int(os.getenv("MEDGEMMA_CONTEXT_TOKENS", "32768")),
+}
+
+# Number of sessions kept in the ledger
+MAX_TRACKED_SESSIONS = 10000
+
+_WORD_OR_SYMBOL = re.compile(r"\w+|[^\w\s]")
+
+_session_id: ContextVar[Optional[str]] = ContextVar("token_session_id", default=None)
+_phase: ContextVar[Optional[str]] = ContextVar("token_phase", default=None)
+
+
+class TokenBudgetExceeded(ValueError):
+    def __init__(self, model: str, estimated: int, limit: int):
+        self.model = model
+        self.estimated = estimated
+        self.limit = limit
+        super().__init__(f"Request to {model} needs ~{estimated} tokens, budget is {limit}")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximates the tokenizer of both backends: one token per punctuation
+    mark and roughly one per four characters of each word.
+    """
+    return sum(math.ceil(len(piece) / 4) for piece in _WORD_OR_SYMBOL.findall(text))
+
+
+def input_budget(model: str, max_tokens: int = 0) -> int:
+    """Tokens left for the input once the requested output is reserved."""
+    return MODEL_CONTEXT_TOKENS[model] - max_tokens
+
+
+def check_budget(model: str, text: str, max_tokens: int = 0) -> int:
+    """
+    Returns the estimated input size of text, raising TokenBudgetExceeded if
+    it does not fit in the model's context together with max_tokens.
+    """
+    estimated = estimate_tokens(text)
+    ensure_within_budget(model, estimated, max_tokens)
+    return estimated
+
+
+def ensure_within_budget(model: str, estimated: int, max_tokens: int = 0) -> None:
+    """Raises TokenBudgetExceeded if an input of estimated tokens does not fit."""
+    limit = input_budget(model, max_tokens)
+    if estimated > limit:
+        raise TokenBudgetExceeded(model, estimated, limit)
+
+
+def render_messages(messages: List[str]) -> str:
+    """Messages as the JSON list sent in report and persona prompts."""
+    return json.dumps(messages, indent=2, ensure_ascii=False)
+
+
+def _rendered_tokens(message: str) -> int:
+    # The message as a JSON string (quotes and escapes included), plus its separating comma
+    return estimate_tokens(json.dumps(message, ensure_ascii=False)) + 1
+
+
+def compact_messages(messages: List[str], budget: int) -> List[str]:
+    """
+    Drops messages from the middle of a conversation until its
+    render_messages form fits in budget tokens, keeping the opening and the
+    most recent messages. The opening is dropped too if it does not fit on
+    its own.
+    """
+    # The enclosing brackets
+    used = 2
+    sizes = [_rendered_tokens(m) for m in messages]
+    if used + sum(sizes) <= budget:
+        return messages
+    # Sized for the largest count, which has at least as many digits as the actual one
+    used += _rendered_tokens(_omitted_marker(len(messages)))
+    head = 1 if messages and used + sizes[0] <= budget else 0
+    used += sum(sizes[:head])
+    start = len(messages)
+    while start > head and used + sizes[start - 1] <= budget:
+        start -= 1
+        used += sizes[start]
+    return messages[:head] + [_omitted_marker(start - head)] + messages[start:]
+
+
+def _omitted_marker(count: int) -> str:
+    return f"[... {count} earlier messages omitted ...]"
+
+
+@contextmanager
+def accounting_context(session_id: Optional[str], phase: Optional[str]):
+    """Attributes the model calls made inside the block to a session and phase."""
+    session_token = _session_id.set(session_id)
+    phase_token = _phase.set(phase)
+    try:
+        yield
+    finally:
+        _phase.reset(phase_token)
+        _session_id.reset(session_token)
+
+
+def current_tags() -> dict:
+    return {"session_id": _session_id.get(), "phase": _phase.get()}
+
+
+def _empty_totals() -> dict:
+    return {
+        "calls": 0,
+        "estimated_input_tokens": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "thinking_tokens": 0,
+        "latency_s": 0.0,
+    }
+
+
+def _add(totals: dict, usage: dict) -> None:
+    totals["calls"] += 1
+    for key in ("estimated_input_tokens", "input_tokens", "output_tokens", "thinking_tokens", "latency_s"):
+        totals[key] += usage[key]
+
+
+class TokenLedger:
+    """
+    Aggregated usage per model, per session and per phase within a session.
+    """
+    def __init__(self, max_sessions: int = MAX_TRACKED_SESSIONS):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._models = {}
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+
+    def record(
+        self,
+        model: str,
+        estimated_input_tokens: int,
+        input_tokens: int,
+        output_tokens: int,
+        thinking_tokens: int,
+        latency_s: float,
+        session_id: Optional[str] = None,
+        phase: Optional[str] = None,
+    ) -> dict:
+        usage = {
+            "model": model,
+            "session_id": session_id,
+            "phase": phase,
+            "estimated_input_tokens": estimated_input_tokens,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "thinking_tokens": thinking_tokens,
+            "latency_s": latency_s,
+        }
+        with self._lock:
+            _add(self._models.setdefault(model, _empty_totals()), usage)
+            if session_id:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    session = self._sessions[session_id] = {"totals": _empty_totals(), "phases": {}}
+                    if len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                else:
+                    self._sessions.move_to_end(session_id)
+                _add(session["totals"], usage)
+                _add(session["phases"].setdefault(phase or "unknown", _empty_totals()), usage)
+        return usage
+
+    def session_summary(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            return {
+                "session_id": session_id,
+                "totals": dict(session["totals"]),
+                "phases": {phase: dict(totals) for phase, totals in session["phases"].items()},
+            }
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "models": {model: dict(totals) for model, totals in self._models.items()},
+                "sessions": len(self._sessions),
+            }
+
+
+ledger = TokenLedger()
+
+
+def record_usage(
+    model: str,
+    estimated_input_tokens: int,
+    input_tokens: Optional[int],
+    output_tokens: int,
+    thinking_tokens: int,
+    latency_s: float,
+    tags: Optional[dict] = None,
+) -> dict:
+    """
+    Records one model call in the ledger. tags defaults to the current
+    accounting context; missing input counts fall back to the estimate.
+    """
+    tags = tags if tags is not None else current_tags()
+    usage = ledger.record(
+        model,
+        estimated_input_tokens,
+        input_tokens if input_tokens is not None else estimated_input_tokens,
+        output_tokens,
+        thinking_tokens,
+        latency_s,
+        session_id=tags.get("session_id"),
+        phase=tags.get("phase"),
+    )
+    record_event("model_call", **usage)
+    return usage
@@ -0,0 +1,88 @@
+"""
+Startup warm-up of each worker.
+
+Pays the cold costs before the worker reports ready instead of on the first
+student's turn: ADC discovery and token fetch, the shared Gemini client and
+its connection, the MedGemma endpoint, and the first PyMuPDF open and render
+of the dyspnea handout. With WARMUP_MODEL_PING, a tiny request is also sent
+to each backend. Failed steps are logged and reported but do not keep the
+worker from serving, since the same work is retried on the first request.
+"""
+import logging
+import os
+import time
+from typing import Callable, Dict
+
+import fitz
+
+from handouts import DYSPNEE_HANDOUT_ID, handout_store, pdf_path
+from models.gemini import GEMINI_MODEL, get_client, google_credentials
+from models.medgemma import endpoint
+from models.router import call_model
+from token_accounting import accounting_context
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated steps to run, in order; empty to skip the warm-up
+WARMUP_STEPS = [step.strip() for step in os.getenv("WARMUP_STEPS", "credentials,gemini,medgemma,handouts").split(",") if step.strip()]
+WARMUP_MODEL_PING = os.getenv("WARMUP_MODEL_PING", "false").lower() == "true"
+PING_PROMPT = "Reply with OK."
+
+
+def _warm_credentials() -> str:
+    # Cached for the process; the Gemini client is created with the same credentials
+    credentials = google_credentials()
+    return f"token valid until {credentials.expiry}"
+
+
+def _warm_gemini() -> str:
+    # Creates the shared client and opens its connection with a metadata call
+    model = get_client().models.get(model=GEMINI_MODEL)
+    if WARMUP_MODEL_PING:
+        with accounting_context(None, "warmup"):
+            call_model("gemini", PING_PROMPT, max_tokens=16, failover=False)
+    return model.name
+
+
+def _warm_medgemma() -> str:
+    # The endpoint is resolved on import; this fetches its credentials and opens the API connection
+    deployed = endpoint.list_models()
+    if WARMUP_MODEL_PING:
+        with accounting_context(None, "warmup"):
+            call_model("medgemma", PING_PROMPT, max_tokens=16, failover=False)
+    return f"{len(deployed)} deployed models"
+
+
+def _warm_handouts() -> str:
+    if not handout_store.loaded:
+        handout_store.load()
+    with fitz.open(pdf_path(DYSPNEE_HANDOUT_ID)) as doc:
+        doc[0].get_pixmap(matrix=fitz.Matrix(0.5, 0.5))
+        return f"{doc.page_count} pages"
+
+
+STEPS: Dict[str, Callable[[], str]] = {
+    "credentials": _warm_credentials,
+    "gemini": _warm_gemini,
+    "medgemma": _warm_medgemma,
+    "handouts": _warm_handouts,
+}
+
+
+def warm_up(steps=None) -> dict:
+    """Runs the warm-up steps and returns their status and duration."""
+    results = {}
+    for name in WARMUP_STEPS if steps is None else steps:
+        step = STEPS.get(name)
+        if step is None:
+            logger.warning(f"Unknown warm-up step: {name}")
+            continue
+        start = time.perf_counter()
+        try:
+            detail = step()
+            results[name] = {"ok": True, "duration_s": round(time.perf_counter() - start, 3), "detail": detail}
+            logger.info(f"Warm-up {name}: {results[name]['duration_s']}s ({detail})")
+        except Exception as e:
+            results[name] = {"ok": False, "duration_s": round(time.perf_counter() - start, 3), "detail": str(e)}
+            logger.warning(f"Warm-up {name} failed after {results[name]['duration_s']}s: {e}")
+    return results
@@ -0,0 +1,219 @@
+"""
+WebSocket session endpoint for the tutoring and virtual-patient chats.
+
+The session state lives server-side for the life of the connection. The client
+sends incremental user messages and receives the model tokens as they stream.
+With "from_persona", the patient is played from the last generated persona
+instead of system_prompt.
+
+Client -> server:
+    {"type": "start", "mode": "tutor" | "patient", "state": {...}, "system_prompt": "...", "history": [...]}
+    {"type": "start", "mode": "patient", "from_persona": true, "history": [...]}
+    {"type": "message", "content": "..."}
+
+Server -> client:
+    {"type": "session", "session_id": "...", "mode": "...", "phase": "..."}
+    {"type": "token", "content": "..."}
+    {"type": "message", "ai_message": "...", "phase": "..."}
+    {"type": "ready", "output": "report" | "virtual_patient"}
+    {"type": "error", "detail": "...", "reconnect": true?}
+
+A message refused with "reconnect", or cut by a close before any token
+arrived, was not processed: the client opens a new connection, starts the session again with
+the history it shows, and resends it.
+"""
+import asyncio
+import json
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from agent import generate_and_store_report_and_patient, stream_step_agent
+from models.gemini import SYSTEM
+from patient_sessions import PatientSession, patient_sessions
+from persona import load_persona, persona_system_prompt
+from lifecycle import lifecycle
+from prompt_builder import ensure_session_id
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+_output_tasks: set = set()
+
+DEFAULT_TUTOR_STATE = {
+    "checklist": {},
+    "phase": "summary",
+    "history": [],
+    "report": "",
+    "virtual_patient": "",
+}
+
+
+class _Connection:
+    """
+    Serializes sends on a socket, since report readiness events are pushed
+    from a background job while tokens may be streaming.
+    """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.closed = False
+        self._lock = asyncio.Lock()
+
+    async def send(self, event: dict) -> None:
+        if self.closed:
+            return
+        async with self._lock:
+            try:
+                await self.websocket.send_json(event)
+            except (WebSocketDisconnect, RuntimeError):
+                self.closed = True
+
+
+class _Session:
+    def __init__(self, mode: str, state: dict, system_prompt: Optional[str]):
+        self.mode = mode
+        self.state = state
+        self.system_prompt = system_prompt
+        # Server-side virtual-patient conversation, in patient mode
+        self.patient: Optional[PatientSession] = None
+        self.outputs_started = False
+
+
+async def _start_session(event: dict) -> _Session:
+    mode = event.get("mode", "tutor")
+    if mode not in ("tutor", "patient"):
+        raise ValueError(f"Unknown session mode: {mode}")
+    state = {**DEFAULT_TUTOR_STATE, "history": [], **(event.get("state") or {})}
+    ensure_session_id(state)
+    system_prompt = event.get("system_prompt") or SYSTEM
+    if mode == "patient" and event.get("from_persona"):
+        persona = await run_in_threadpool(load_persona)
+        if persona is None:
+            raise ValueError("No virtual patient persona generated yet")
+        system_prompt = persona_system_prompt(persona)
+    session = _Session(mode, state, system_prompt)
+    if mode == "patient":
+        session.patient = await run_in_threadpool(
+            patient_sessions.create, session.system_prompt, event.get("history"), state["session_id"]
+        )
+    return session
+
+
+async def _close_session(session: Optional[_Session]) -> None:
+    if session is not None and session.patient is not None:
+        await run_in_threadpool(patient_sessions.close, session.patient.session_id)
+
+
+async def _stream_reply(conn: _Connection, chunks) -> str:
+    parts = []
+    async for chunk in iterate_in_threadpool(chunks):
+        parts.append(chunk)
+        await conn.send({"type": "token", "content": chunk})
+    return "".join(parts).strip()
+
+
+async def _tutor_turn(conn: _Connection, session: _Session, content: str) -> None:
+    if session.state["phase"] == "outputs":
+        await conn.send({"type": "error", "detail": "Tutoring session is over"})
+        return
+    ai_message = await _stream_reply(conn, stream_step_agent(session.state, content, session.system_prompt))
+    await conn.send({"type": "message", "ai_message": ai_message, "phase": session.state["phase"]})
+
+    if session.state["phase"] == "outputs" and not session.outputs_started:
+        session.outputs_started = True
+        task = asyncio.create_task(_generate_outputs(conn, session.state))
+        # Keep a reference so the job outlives the connection
+        _output_tasks.add(task)
+        task.add_done_callback(_output_tasks.discard)
+
+
+async def _patient_turn(conn: _Connection, session: _Session, content: str) -> None:
+    ai_message = await _stream_reply(conn, session.patient.stream_reply(content))
+    await conn.send({"type": "message", "ai_message": ai_message, "phase": session.state["phase"]})
+
+
+async def _generate_outputs(conn: _Connection, state: dict) -> None:
+    """
+    Generates the report and virtual patient off the event loop and pushes a
+    readiness event for each. Generation completes even if the client left.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_ready(output: str) -> None:
+        asyncio.run_coroutine_threadsafe(conn.send({"type": "ready", "output": output}), loop)
+
+    try:
+        await run_in_threadpool(lifecycle.run_job, generate_and_store_report_and_patient, state, on_ready)
+    except Exception:
+        logger.exception("Report generation failed for session %s", state.get("session_id"))
+        await conn.send({"type": "error", "detail": "Report generation failed"})
+
+
+async def _receive_event(websocket: WebSocket) -> dict:
+    """Next client event, raising ValueError if the frame is not a JSON object."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    try:
+        event = json.loads(message.get("text") or message.get("bytes") or "")
+    except ValueError:
+        raise ValueError("Events must be JSON objects") from None
+    if not isinstance(event, dict):
+        raise ValueError("Events must be JSON objects")
+    return event
+
+
+@router.websocket("/ws/session")
+async def session_websocket(websocket: WebSocket):
+    await websocket.accept()
+    conn = _Connection(websocket)
+    session: Optional[_Session] = None
+    try:
+        while True:
+            try:
+                event = await _receive_event(websocket)
+                kind = event.get("type")
+                if kind == "start":
+                    await _close_session(session)
+                    session = None
+                    session = await _start_session(event)
+                    logger.info(f"=== WS SESSION {session.state['session_id']} ({session.mode}) ===")
+                    await conn.send({
+                        "type": "session",
+                        "session_id": session.state["session_id"],
+                        "mode": session.mode,
+                        "phase": session.state["phase"],
+                    })
+                elif kind == "message":
+                    if lifecycle.draining:
+                        # The turn would be cut when the worker exits; the client reconnects to another one
+                        await conn.send({"type": "error", "detail": "Server is restarting, reconnect to continue", "reconnect": True})
+                        await websocket.close(code=1012)
+                        conn.closed = True
+                        return
+                    if session is None:
+                        session = await _start_session({})
+                    with lifecycle.job():
+                        if session.mode == "tutor":
+                            await _tutor_turn(conn, session, event.get("content", ""))
+                        else:
+                            await _patient_turn(conn, session, event.get("content", ""))
+                else:
+                    await conn.send({"type": "error", "detail": f"Unknown event type: {kind}"})
+            except WebSocketDisconnect:
+                raise
+            except ValueError as e:
+                await conn.send({"type": "error", "detail": str(e)})
+            except Exception:
+                logger.exception("WebSocket turn failed")
+                await conn.send({"type": "error", "detail": "Model call failed"})
+    except WebSocketDisconnect:
+        conn.closed = True
+    finally:
+        # Also on errors and cancellation, so a patient session and its context cache never outlive the socket
+        await _close_session(session)
+        if session is not None:
+            logger.info(f"=== WS SESSION {session.state['session_id']} CLOSED ===")
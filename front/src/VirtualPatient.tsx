@@ -12,26 +12,39 @@ declare module 'react' {
   }
 }
 
-// Initial session state for the agent - now empty by default
-const initialState = {
-  checklist: {},
-  phase: "summary",
-  history: [],
-  report: "",
-  virtual_patient: "",
-};
+const API_URL = "http://localhost:8000";
+const WS_URL = API_URL.replace(/^http/, "ws");
 
 type Message = {
   role: "user" | "ai";
   content: string;
 };
 
+// A turn that failed; reconnect is set when it was not processed and can be resent
+type TurnFailure = {
+  detail: string;
+  reconnect: boolean;
+};
+
+// Fields of the generated persona shown in the settings
+type PersonaSummary = {
+  name: string;
+  age: number;
+  chief_complaint: string;
+};
+
+type TurnHandlers = {
+  socket: WebSocket;
+  onToken: (token: string) => void;
+  onDone: (reply: string) => void;
+  onError: (failure: TurnFailure) => void;
+};
+
 const INPUT_HEIGHT = 90;
 
 function App() {
   const [messages, setMessages] = useState<Message[]>([]);
   const [input, setInput] = useState("");
-  const [sessionState, setSessionState] = useState<any>(initialState);
   const [loading, setLoading] = useState(false);
   const [showSettings, setShowSettings] = useState(false);
   const [systemPrompt, setSystemPrompt] = useState(`You are roleplaying as a patient for medical education purposes. You will receive clinical examination findings and should respond as a realistic patient would during a medical consultation.
@@ -61,6 +74,9 @@ Pulmonary:
 - Cough
 - Even more difficulty breathing when lying down`);
   const [initialMessage, setInitialMessage] = useState("Hi, What brings you here today?");
+  // Persona generated at the end of the last tutor session; the system prompt above is only a fallback
+  const [persona, setPersona] = useState<PersonaSummary | null>(null);
+  const [usePersona, setUsePersona] = useState(false);
   const inputRef = useRef<HTMLInputElement>(null);
   const chatRef = useRef<HTMLDivElement>(null);
 
@@ -80,6 +96,18 @@ Pulmonary:
     };
   }, []);
 
+  useEffect(() => {
+    fetch(`${API_URL}/patient/persona`)
+      .then((res) => (res.ok ? res.json() : null))
+      .then((data: PersonaSummary | null) => {
+        if (data) {
+          setPersona(data);
+          setUsePersona(true);
+        }
+      })
+      .catch(() => {});
+  }, []);
+
   // Don't fetch initial AI message automatically - wait for user to start
   useEffect(() => {
     // Auto-scroll to bottom on new message
@@ -88,32 +116,109 @@ Pulmonary:
     }
   }, [messages]);
 
+  // Server-side conversation over a WebSocket, which stays on one server worker:
+  // the persona is sent once, then only new messages
+  const socketRef = useRef<WebSocket | null>(null);
+  const turnRef = useRef<TurnHandlers | null>(null);
+
+  const closeSession = () => {
+    socketRef.current?.close();
+    socketRef.current = null;
+  };
+
+  // A new persona starts a new conversation, leaving the page ends it
+  useEffect(() => () => {
+    socketRef.current?.close();
+    socketRef.current = null;
+  }, [systemPrompt, usePersona]);
+
+  // Events of a closed socket must not reach the turn running on its replacement
+  const currentTurn = (socket: WebSocket) =>
+    turnRef.current?.socket === socket ? turnRef.current : null;
+
+  const openSession = (history: Message[]) =>
+    new Promise<WebSocket>((resolve, reject) => {
+      const socket = new WebSocket(`${WS_URL}/ws/session`);
+      socket.onopen = () => {
+        // The server builds the prompt from the stored persona, so the chat plays the generated case
+        const patient = usePersona ? { from_persona: true } : { system_prompt: systemPrompt };
+        socket.send(JSON.stringify({ type: "start", mode: "patient", ...patient, history }));
+      };
+      socket.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === "session") {
+          socketRef.current = socket;
+          resolve(socket);
+        } else if (data.type === "token") {
+          currentTurn(socket)?.onToken(data.content);
+        } else if (data.type === "message") {
+          currentTurn(socket)?.onDone(data.ai_message);
+        } else if (data.type === "error") {
+          reject(new Error(data.detail));
+          currentTurn(socket)?.onError({ detail: data.detail, reconnect: Boolean(data.reconnect) });
+        }
+      };
+      socket.onclose = () => {
+        if (socketRef.current === socket) socketRef.current = null;
+        reject(new Error("Connection closed"));
+        currentTurn(socket)?.onError({ detail: "Connection closed", reconnect: true });
+      };
+    });
+
+  // Updates the reply being streamed, unless the conversation was reset meanwhile
+  const setLastReply = (update: (content: string) => string) =>
+    setMessages((msgs) => {
+      const last = msgs[msgs.length - 1];
+      if (!last || last.role !== "ai") return msgs;
+      return [...msgs.slice(0, -1), { role: "ai", content: update(last.content) }];
+    });
+
+  const runTurn = (socket: WebSocket, message: string) =>
+    new Promise<string>((resolve, reject) => {
+      let streamed = false;
+      turnRef.current = {
+        socket,
+        onToken: (token) => {
+          streamed = true;
+          setLastReply((content) => content + token);
+        },
+        onDone: (reply) => {
+          turnRef.current = null;
+          resolve(reply);
+        },
+        onError: (failure) => {
+          turnRef.current = null;
+          // Once tokens arrived the server processed the message, it must not be resent
+          reject({ ...failure, reconnect: failure.reconnect && !streamed });
+        },
+      };
+      socket.send(JSON.stringify({ type: "message", content: message }));
+    });
+
   const sendMessage = async (e: FormEvent) => {
     e.preventDefault();
     if (!input.trim()) return;
     const userMsg = input.trim();
-    const updatedMessages = [...messages, { role: "user" as const, content: userMsg }];
-    setMessages(updatedMessages);
+    const previousMessages = messages;
+    setMessages([...messages, { role: "user" as const, content: userMsg }, { role: "ai" as const, content: "" }]);
     setInput("");
     setLoading(true);
 
     try {
-      // Use the simple chat endpoint for clean conversations
-      const res = await fetch("http://localhost:8000/chat/simple", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          message: userMsg,
-          state: sessionState,
-          system_prompt: systemPrompt,
-          history: updatedMessages
-        }),
-      });
-      const data = await res.json();
-      setMessages((msgs) => [...msgs, { role: "ai", content: data.ai_message }]);
-      setSessionState(data.state);
+      const socket = socketRef.current ?? (await openSession(previousMessages));
+      let reply: string;
+      try {
+        reply = await runTurn(socket, userMsg);
+      } catch (failure) {
+        if (!(failure as TurnFailure).reconnect) throw failure;
+        // The connection was lost (e.g. the server restarted): resume on a new one from the messages shown
+        reply = await runTurn(await openSession(previousMessages), userMsg);
+      }
+      setLastReply(() => reply);
     } catch (err) {
-      setMessages((msgs) => [...msgs, { role: "ai", content: "Error: Could not reach backend." }]);
+      // Errors starting the session (e.g. no persona generated yet) carry the server's detail
+      const detail = err instanceof Error && err.message !== "Connection closed" ? err.message : "Could not reach backend.";
+      setLastReply(() => `Error: ${detail}`);
     } finally {
       setLoading(false);
       inputRef.current?.focus();
@@ -121,8 +226,8 @@ Pulmonary:
   };
 
   const resetConversation = () => {
+    closeSession();
     setMessages([]);
-    setSessionState(initialState);
     setInput("");
     // No automatic initial message - wait for user to start
   };
@@ -246,6 +351,26 @@ Pulmonary:
           }}
         >
           <div style={{ marginBottom: 16 }}>
+            <label
+              style={{
+                display: "flex",
+                alignItems: "center",
+                gap: 8,
+                color: persona ? "#fff" : "#888",
+                fontSize: 14,
+                marginBottom: 12,
+              }}
+            >
+              <input
+                type="checkbox"
+                checked={usePersona}
+                disabled={!persona}
+                onChange={(e) => setUsePersona(e.target.checked)}
+              />
+              {persona
+                ? `Use the generated patient: ${persona.name}, ${persona.age} (${persona.chief_complaint})`
+                : "No generated patient yet: finish a tutor session to create one"}
+            </label>
             <label
               style={{
                 display: "block",
@@ -259,6 +384,7 @@ Pulmonary:
             </label>
             <textarea
               value={systemPrompt}
+              disabled={usePersona}
               onChange={(e) => setSystemPrompt(e.target.value)}
               placeholder="Enter your custom system prompt..."
               style={{